@@ -16,25 +16,36 @@ import asyncio
 import json
 import logging
 import time
-import requests
+from datetime import datetime
 import platform
+import re
+import random
+import email.utils
+import uuid
 from pathlib import Path
 from typing import Dict, List, Optional
-import subprocess
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import sqlite3
+import errno
+import hashlib
+import contextlib
+import contextvars
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Async HTTP client for the transfer engine, also serves /metrics and /healthz
+import aiohttp
+from aiohttp import web
 
 # Core telegram imports
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
-from telegram.ext import Application, CommandHandler, ContextTypes, InlineQueryHandler
+from telegram.ext import Application, CommandHandler, ContextTypes, InlineQueryHandler, ChatMemberHandler
 from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 
-# Google Drive imports - CLI optimized
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.http import MediaFileUpload
+# Google client libraries are imported lazily by GoogleDriveManager,
+# they add seconds to every restart on the STB
 
 # Setup logging
 logging.basicConfig(
@@ -54,6 +65,8 @@ GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 TOKEN_FILE = '/app/data/token.json'
+# Access tokens are refreshed in the background this many seconds before they expire
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '600'))
 CREDENTIALS_FILE = '/app/credentials/credentials.json'
 
 # Channel subscription settings - INTEGRATED
@@ -61,10 +74,110 @@ REQUIRED_CHANNEL = '@ZalheraThink'
 CHANNEL_URL = 'https://t.me/ZalheraThink'
 CHANNEL_ID = -1001802424804  # Integrated actual channel ID
 
+# Membership results are cached, negatives expire sooner so new joiners get in quickly
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '600'))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '5000'))
+
 # Settings for STB
 MAX_CONCURRENT = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '2'))
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', '20'))
+MAX_QUEUED_PER_USER = int(os.getenv('MAX_QUEUED_PER_USER', '5'))
+# Disk-staged files are uploaded by a separate pool, fed through a bounded hand-off queue
+MAX_CONCURRENT_UPLOADS = int(os.getenv('MAX_CONCURRENT_UPLOADS', '2'))
+UPLOAD_HANDOFF_QUEUE = int(os.getenv('UPLOAD_HANDOFF_QUEUE', '2'))
+# Disk-mode jobs only start when their file fits, keeping headroom for logs and the journal
+DOWNLOAD_DIR = '/app/downloads'
+MIN_FREE_SPACE = int(os.getenv('MIN_FREE_SPACE_MB', '256')) * 1024 * 1024
+# A submit-time probe older than this is redone when the job starts (signed URLs expire)
+PROBE_MAX_AGE = float(os.getenv('PROBE_MAX_AGE', '60'))
 MAX_SPEED_MBPS = float(os.getenv('MAX_SPEED_MBPS', '10'))
-CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '8192'))
+USER_MAX_SPEED_MBPS = float(os.getenv('USER_MAX_SPEED_MBPS', '0'))
+SPEED_BURST_MB = float(os.getenv('SPEED_BURST_MB', '4'))
+THROTTLE_UPLOADS = os.getenv('THROTTLE_UPLOADS', 'false').lower() in ('1', 'true', 'yes')
+# Network reads grow from CHUNK_SIZE up to CHUNK_SIZE_MAX with measured throughput,
+# disk writes are batched through a preallocated WRITE_BUFFER_MB buffer
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '65536'))
+CHUNK_SIZE_MAX = max(CHUNK_SIZE, int(os.getenv('CHUNK_SIZE_MAX', str(1024 * 1024))))
+CHUNK_READS_PER_SECOND = 20
+WRITE_BUFFER_SIZE = int(os.getenv('WRITE_BUFFER_MB', '1')) * 1024 * 1024
+DOWNLOAD_SEGMENTS = int(os.getenv('DOWNLOAD_SEGMENTS', '4'))
+MIN_SEGMENT_SIZE = int(os.getenv('MIN_SEGMENT_SIZE_MB', '4')) * 1024 * 1024
+
+# Stalled or dropped downloads reconnect with a Range request instead of failing the job
+DOWNLOAD_STALL_TIMEOUT = float(os.getenv('DOWNLOAD_STALL_TIMEOUT', '30'))
+DOWNLOAD_STALL_WINDOW = float(os.getenv('DOWNLOAD_STALL_WINDOW', '60'))
+DOWNLOAD_MIN_SPEED = float(os.getenv('DOWNLOAD_MIN_SPEED_KB', '4')) * 1024
+DOWNLOAD_MAX_RETRIES = int(os.getenv('DOWNLOAD_MAX_RETRIES', '5'))
+DOWNLOAD_RETRY_BASE = float(os.getenv('DOWNLOAD_RETRY_BASE', '1'))
+DOWNLOAD_RETRY_MAX_DELAY = float(os.getenv('DOWNLOAD_RETRY_MAX_DELAY', '30'))
+
+# Streaming mode: pipe downloads straight into Drive without staging on disk
+STREAM_UPLOADS = os.getenv('STREAM_UPLOADS', 'true').lower() in ('1', 'true', 'yes')
+STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_MB', '16')) * 1024 * 1024
+# Drive requires resumable chunks in multiples of 256 KB
+UPLOAD_CHUNK_SIZE = max(1, int(os.getenv('UPLOAD_CHUNK_MB', '8')) * 4) * 256 * 1024
+# upload_stream waits for a whole chunk, so the buffer must fit one plus a read or both sides stall
+STREAM_BUFFER_SIZE = max(STREAM_BUFFER_SIZE, UPLOAD_CHUNK_SIZE + CHUNK_SIZE_MAX)
+DRIVE_UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3'
+DRIVE_BATCH_URL = 'https://www.googleapis.com/batch/drive/v3'
+# Failed upload chunks are retried from Drive's committed offset with jittered backoff
+UPLOAD_MAX_RETRIES = int(os.getenv('UPLOAD_MAX_RETRIES', '8'))
+UPLOAD_RETRY_BASE = float(os.getenv('UPLOAD_RETRY_BASE', '1'))
+UPLOAD_RETRY_MAX_DELAY = float(os.getenv('UPLOAD_RETRY_MAX_DELAY', '60'))
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Multi-link /d batches and coalesced Drive permission calls
+MAX_BATCH_URLS = int(os.getenv('MAX_BATCH_URLS', '20'))
+PERMISSION_BATCH_WINDOW = float(os.getenv('PERMISSION_BATCH_WINDOW', '1'))
+PERMISSION_BATCH_SIZE = 100  # Drive's per-batch request limit
+
+# Shared aiohttp connection pool for source downloads
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+HTTP_READ_TIMEOUT = int(os.getenv('HTTP_READ_TIMEOUT', '300'))
+
+# Separate keep-alive pool for Google APIs so chunks and permission calls reuse TLS connections
+DRIVE_POOL_SIZE = int(os.getenv('DRIVE_POOL_SIZE', '8'))
+DRIVE_KEEPALIVE = int(os.getenv('DRIVE_KEEPALIVE', '120'))
+
+# Status message progress edits, kept under Telegram's per-chat edit limits
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '5'))
+PROGRESS_CHAT_INTERVAL = float(os.getenv('PROGRESS_CHAT_INTERVAL', '3'))
+PROGRESS_WINDOW = 10
+
+# Persistent job journal so restarts resume instead of starting over
+JOURNAL_DB = os.getenv('JOURNAL_DB', '/app/data/jobs.db')
+JOURNAL_INTERVAL = float(os.getenv('JOURNAL_INTERVAL', '2'))
+
+# URL -> Drive result cache so repeated links skip the transfer entirely
+URL_CACHE_DB = os.getenv('URL_CACHE_DB', JOURNAL_DB)
+URL_CACHE_MAX_ENTRIES = int(os.getenv('URL_CACHE_MAX_ENTRIES', '2000'))
+URL_CACHE_MAX_AGE_DAYS = int(os.getenv('URL_CACHE_MAX_AGE_DAYS', '30'))
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'igshid', 'ref_src')
+
+# Content-hash dedup: identical bytes behind different URLs map to one Drive file
+HASH_SHA256 = os.getenv('HASH_SHA256', 'false').lower() in ('1', 'true', 'yes')
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_INDEX_REFRESH = int(os.getenv('HASH_INDEX_REFRESH', '3600'))
+
+# Background system sampler for /system, /stats and inline queries
+SYSTEM_SAMPLE_INTERVAL = int(os.getenv('SYSTEM_SAMPLE_INTERVAL', '10'))
+SYSTEM_HISTORY_MINUTES = int(os.getenv('SYSTEM_HISTORY_MINUTES', '15'))
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+
+# Inline mode caching: Telegram-side cache hints and per-user keystroke debounce
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))
+INLINE_SYSTEM_TTL = int(os.getenv('INLINE_SYSTEM_TTL', '30'))
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.4'))
+
+# Prometheus text-format metrics and a /healthz route for the container healthcheck, 0 disables
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8080'))
+HEALTH_POLL_MAX_AGE = int(os.getenv('HEALTH_POLL_MAX_AGE', '120'))
+
+# Per-job stage traces for /perf, persisted next to the journal unless PERF_DB is empty
+PERF_RING_SIZE = int(os.getenv('PERF_RING_SIZE', '200'))
+PERF_DB = os.getenv('PERF_DB', JOURNAL_DB)
 
 # Bot info for inline
 BOT_USERNAME = os.getenv('BOT_USERNAME', 'your_bot_username')
@@ -79,23 +192,156 @@ def ensure_directories():
 
 ensure_directories()
 
+class MetricsRegistry:
+    """Counters and duration summaries in Prometheus text format
+
+    Transfer code bumps plain dict entries inline; gauges such as queue
+    depth or temperature are read from the live objects on each scrape.
+    """
+
+    HELP = {
+        'stb_download_bytes_total': ('counter', 'Bytes received from download origins'),
+        'stb_upload_bytes_total': ('counter', 'Bytes sent to Google Drive'),
+        'stb_stage_seconds': ('summary', 'Time spent per job stage'),
+        'stb_throttle_seconds_total': ('counter', 'Time transfers slept in the bandwidth limiter'),
+        'stb_jobs_total': ('counter', 'Finished jobs by result'),
+        'stb_telegram_request_seconds': ('summary', 'Telegram Bot API call latency'),
+        'stb_telegram_errors_total': ('counter', 'Failed Telegram Bot API calls'),
+    }
+
+    def __init__(self):
+        self.counters = {}
+        self.summaries = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        entry = self.summaries.setdefault(self._key(name, labels), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            name += '{' + ','.join(f'{key}="{label}"' for key, label in labels) + '}'
+        return f"{name} {value:g}" if isinstance(value, float) else f"{name} {value}"
+
+    def render(self, gauges):
+        """Exposition text; gauges are (name, help, [(labels dict, value), ...])"""
+        lines = []
+        families = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            families.setdefault(name, []).append(self._format(name, labels, value))
+        for (name, labels), (count, total) in sorted(self.summaries.items()):
+            families.setdefault(name, []).extend([
+                self._format(f"{name}_count", labels, count),
+                self._format(f"{name}_sum", labels, float(total)),
+            ])
+        for name, samples in families.items():
+            kind, text = self.HELP.get(name, ('untyped', name))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + samples
+
+        for name, text, samples in gauges:
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            lines += [self._format(name, tuple(sorted(labels.items())), value) for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API transport that records per-method latency and errors
+
+    A successful getUpdates also marks the polling loop as alive for /healthz.
+    """
+
+    last_poll = time.monotonic()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.monotonic()
+        try:
+            status, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metrics.inc('stb_telegram_errors_total', method=api_method)
+            raise
+        finally:
+            metrics.observe('stb_telegram_request_seconds', time.monotonic() - started, method=api_method)
+
+        if status >= 400:
+            metrics.inc('stb_telegram_errors_total', method=api_method)
+        elif api_method == 'getUpdates':
+            InstrumentedRequest.last_poll = time.monotonic()
+        return status, payload
+
+class SubscriptionCache:
+    """LRU cache of channel membership results with separate positive/negative TTLs"""
+
+    def __init__(self, ttl=SUBSCRIPTION_CACHE_TTL, negative_ttl=SUBSCRIPTION_NEGATIVE_TTL,
+                 max_size=SUBSCRIPTION_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Cached result for user_id, or None on miss/expiry"""
+        entry = self.entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, subscribed):
+        ttl = self.ttl if subscribed else self.negative_ttl
+        self.entries[user_id] = (subscribed, time.monotonic() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
 class ChannelSubscriptionCheck:
     """Channel subscription verification with integrated channel ID"""
 
+    MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
     @staticmethod
     async def is_user_subscribed(context, user_id):
         """Check if user is subscribed to required channel"""
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+
         try:
             # Try to get chat member status
             member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
 
             # Check if user is member, administrator, or creator
-            if member.status in ['member', 'administrator', 'creator']:
+            subscribed = member.status in ChannelSubscriptionCheck.MEMBER_STATUSES
+            subscription_cache.set(user_id, subscribed)
+
+            if subscribed:
                 logger.info(f"✅ User {user_id} is subscribed to {REQUIRED_CHANNEL}")
-                return True
             else:
                 logger.info(f"❌ User {user_id} is not subscribed to {REQUIRED_CHANNEL}")
-                return False
+            return subscribed
 
         except (BadRequest, Forbidden) as e:
             logger.warning(f"Could not check subscription for user {user_id}: {e}")
@@ -134,6 +380,17 @@ Click the button below to join, then try again.
             reply_markup=reply_markup
         )
 
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Refresh cached membership as soon as someone joins or leaves the channel"""
+    change = update.chat_member
+    if not change or change.chat.id != CHANNEL_ID:
+        return
+
+    user_id = change.new_chat_member.user.id
+    subscribed = change.new_chat_member.status in ChannelSubscriptionCheck.MEMBER_STATUSES
+    subscription_cache.set(user_id, subscribed)
+    logger.info(f"🔄 Channel membership changed: user {user_id} subscribed={subscribed}")
+
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Decorator function to check channel subscription"""
     user_id = update.effective_user.id
@@ -150,7 +407,18 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return True
 
 class STBSystemInfo:
-    """System information for STB HG680P"""
+    """System information for STB HG680P
+
+    A background task samples /proc, statvfs and the thermal zone every
+    SYSTEM_SAMPLE_INTERVAL seconds into a ring buffer, so handlers read a
+    cached snapshot instead of forking df/uptime/cat on the event loop.
+    """
+
+    def __init__(self, interval=SYSTEM_SAMPLE_INTERVAL, history_minutes=SYSTEM_HISTORY_MINUTES):
+        self.interval = interval
+        self.samples = deque(maxlen=max(1, history_minutes * 60 // interval))
+        self.static_info = None
+        self.task = None
 
     @staticmethod
     def get_architecture():
@@ -169,66 +437,167 @@ class STBSystemInfo:
             return 'aarch64'
 
     @staticmethod
-    def get_system_info():
-        """Get detailed STB system information"""
-        try:
-            # Memory info
-            with open('/proc/meminfo', 'r') as f:
-                mem_info = f.read()
-                mem_total = [line for line in mem_info.split('\n') if 'MemTotal' in line]
-                mem_total = mem_total[0].split()[1] if mem_total else "Unknown"
+    def format_size(size):
+        """Human readable size in the style of df -h"""
+        for unit in ('B', 'K', 'M', 'G', 'T'):
+            if size < 1024 or unit == 'T':
+                return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+            size /= 1024
+
+    @staticmethod
+    def read_meminfo():
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                parts = value.split()
+                if parts and parts[0].isdigit():
+                    meminfo[key] = int(parts[0]) * 1024
+        return meminfo
+
+    def load_static_info(self):
+        """Values that never change while the container runs"""
+        info = {'architecture': self.get_architecture(), 'cpu': "ARM CPU", 'memory': "Unknown"}
 
-            # CPU info
+        try:
             with open('/proc/cpuinfo', 'r') as f:
-                cpu_info = f.read()
-                cpu_model = [line for line in cpu_info.split('\n') if 'model name' in line]
-                cpu_model = cpu_model[0].split(':')[1].strip() if cpu_model else "Unknown ARM CPU"
-
-            # Storage info
-            storage = subprocess.run(['df', '-h', '/'], capture_output=True, text=True)
-            storage_info = storage.stdout.split('\n')[1].split() if storage.returncode == 0 else ["Unknown"]
-
-            return {
-                'architecture': STBSystemInfo.get_architecture(),
-                'memory': f"{int(mem_total)//1024} MB" if mem_total != "Unknown" else "Unknown",
-                'cpu': cpu_model,
-                'storage_total': storage_info[1] if len(storage_info) > 1 else "Unknown",
-                'storage_used': storage_info[2] if len(storage_info) > 2 else "Unknown",
-                'storage_available': storage_info[3] if len(storage_info) > 3 else "Unknown"
-            }
+                for line in f:
+                    if line.startswith('model name') or line.startswith('Hardware'):
+                        info['cpu'] = line.split(':', 1)[1].strip()
+                        break
+                else:
+                    info['cpu'] = "Unknown ARM CPU"
+
+            mem_total = self.read_meminfo().get('MemTotal')
+            if mem_total:
+                info['memory'] = f"{mem_total // (1024 * 1024)} MB"
         except Exception as e:
             logger.warning(f"Could not get system info: {e}")
-            return {
-                'architecture': STBSystemInfo.get_architecture(),
-                'memory': "Unknown",
-                'cpu': "ARM CPU",
-                'storage_total': "Unknown",
-                'storage_used': "Unknown",
-                'storage_available': "Unknown"
-            }
+
+        return info
+
+    def sample(self):
+        """Take one reading, cheap enough to run on the event loop"""
+        snapshot = {'time': time.time(), 'load': (0.0, 0.0, 0.0), 'temperature': 0.0, 'uptime': 0,
+                    'mem_available': 0, 'disk_total': 0, 'disk_used': 0, 'disk_free': 0}
+
+        try:
+            snapshot['load'] = os.getloadavg()
+        except OSError:
+            pass
+
+        try:
+            with open(THERMAL_ZONE, 'r') as f:
+                snapshot['temperature'] = int(f.read().strip()) / 1000
+        except (OSError, ValueError):
+            pass
+
+        try:
+            with open('/proc/uptime', 'r') as f:
+                snapshot['uptime'] = int(float(f.read().split()[0]))
+            snapshot['mem_available'] = self.read_meminfo().get('MemAvailable', 0)
+        except (OSError, ValueError):
+            pass
+
+        try:
+            stat = os.statvfs('/')
+            snapshot['disk_total'] = stat.f_blocks * stat.f_frsize
+            snapshot['disk_used'] = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+            snapshot['disk_free'] = stat.f_bavail * stat.f_frsize
+        except OSError:
+            pass
+
+        self.samples.append(snapshot)
+        return snapshot
+
+    def start(self):
+        """Start the sampler on the running event loop"""
+        self.task = asyncio.create_task(self._run(), name="stb-system-sampler")
+
+    async def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning(f"System sample failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def latest(self):
+        return self.samples[-1] if self.samples else self.sample()
+
+    def history(self, minutes=SYSTEM_HISTORY_MINUTES):
+        cutoff = time.time() - minutes * 60
+        return [snapshot for snapshot in self.samples if snapshot['time'] >= cutoff]
+
+    @staticmethod
+    def format_uptime(seconds):
+        days, seconds = divmod(seconds, 86400)
+        hours, seconds = divmod(seconds, 3600)
+        minutes = seconds // 60
+        return f"{days}d {hours}h {minutes}m" if days else f"{hours}h {minutes}m"
+
+    def get_system_info(self):
+        """Get detailed STB system information from the latest cached sample"""
+        if self.static_info is None:
+            self.static_info = self.load_static_info()
+
+        snapshot = self.latest()
+        info = dict(self.static_info)
+
+        if snapshot['disk_total']:
+            info['storage_total'] = self.format_size(snapshot['disk_total'])
+            info['storage_used'] = self.format_size(snapshot['disk_used'])
+            info['storage_available'] = self.format_size(snapshot['disk_free'])
+        else:
+            info['storage_total'] = info['storage_used'] = info['storage_available'] = "Unknown"
+
+        info['temperature'] = snapshot['temperature']
+        info['load'] = snapshot['load']
+        info['uptime'] = self.format_uptime(snapshot['uptime']) if snapshot['uptime'] else "Unknown"
+        return info
 
 class GoogleDriveManager:
     """CLI-optimized Google Drive manager for STB"""
 
     def __init__(self):
-        self.service = None
         self.credentials = None
-        self.load_credentials()
+        self.connected = False
+        self.ready = None
+        self.refresher = None
+        self.refresh_lock = asyncio.Lock()
+        self.share_queue = []
+        self.share_flush = None
+        self.upload_retries = 0
+        self.resent_bytes = 0
+
+    def start(self):
+        """Load saved credentials in a worker thread so polling starts without waiting"""
+        self.ready = asyncio.create_task(asyncio.to_thread(self.load_credentials))
+        self.refresher = asyncio.create_task(self.token_refresher())
+
+    async def wait_ready(self):
+        if self.ready:
+            await self.ready
 
     def load_credentials(self):
         """Load existing credentials from token file"""
         try:
             if os.path.exists(TOKEN_FILE):
+                from google.oauth2.credentials import Credentials
+                from google.auth.transport.requests import Request
+
                 with open(TOKEN_FILE, 'r') as f:
                     token_data = json.load(f)
 
+                expiry = token_data.get('expiry')
                 self.credentials = Credentials(
                     token=token_data.get('token'),
                     refresh_token=token_data.get('refresh_token'),
                     client_id=GOOGLE_CLIENT_ID,
                     client_secret=GOOGLE_CLIENT_SECRET,
                     token_uri='https://oauth2.googleapis.com/token',
-                    scopes=SCOPES
+                    scopes=SCOPES,
+                    expiry=datetime.fromisoformat(expiry) if expiry else None
                 )
 
                 if self.credentials.expired and self.credentials.refresh_token:
@@ -236,7 +605,7 @@ class GoogleDriveManager:
                     self.save_credentials()
 
                 if self.credentials.valid:
-                    self.service = build('drive', 'v3', credentials=self.credentials, cache_discovery=False)
+                    self.connected = True
                     logger.info("✅ Google Drive authenticated successfully")
 
         except Exception as e:
@@ -272,6 +641,8 @@ class GoogleDriveManager:
             if not self.create_credentials_json():
                 return None, "Could not create credentials file"
 
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
 
             auth_url, _ = flow.authorization_url(
@@ -299,7 +670,7 @@ class GoogleDriveManager:
             self.credentials = self._flow.credentials
 
             self.save_credentials()
-            self.service = build('drive', 'v3', credentials=self.credentials, cache_discovery=False)
+            self.connected = True
 
             logger.info("✅ CLI authentication completed successfully")
             return True, None
@@ -309,115 +680,2225 @@ class GoogleDriveManager:
             return False, str(e)
 
     def save_credentials(self):
-        """Save credentials to token file"""
+        """Save credentials to token file, atomically so a crash never leaves it half written"""
+        tmp_path = None
         try:
             token_data = {
                 'token': self.credentials.token,
                 'refresh_token': self.credentials.refresh_token,
                 'client_id': self.credentials.client_id,
                 'client_secret': self.credentials.client_secret,
-                'scopes': self.credentials.scopes
+                'scopes': self.credentials.scopes,
+                'expiry': self.credentials.expiry.isoformat() if self.credentials.expiry else None
             }
 
-            with open(TOKEN_FILE, 'w') as f:
+            # mkstemp creates the file 0600 next to the target, os.replace swaps it in
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(TOKEN_FILE), prefix='.token-')
+            with os.fdopen(fd, 'w') as f:
                 json.dump(token_data, f, indent=2)
-
-            os.chmod(TOKEN_FILE, 0o600)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, TOKEN_FILE)
+            tmp_path = None
             logger.info("💾 Credentials saved securely")
 
         except Exception as e:
             logger.error(f"Save credentials failed: {e}")
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def expires_in(self):
+        """Seconds until the access token expires, None if unknown"""
+        if not self.credentials or not self.credentials.expiry:
+            return None
+        return (self.credentials.expiry - datetime.utcnow()).total_seconds()
+
+    def needs_refresh(self, margin=0):
+        if not self.credentials or not self.credentials.refresh_token:
+            return False
+        remaining = self.expires_in()
+        return not self.credentials.valid or remaining is None or remaining < margin
+
+    async def refresh_credentials(self, margin=0):
+        """Single-flight refresh: concurrent callers wait for the one refresh in progress"""
+        async with self.refresh_lock:
+            # Whoever held the lock before us may already have refreshed
+            if not self.needs_refresh(margin):
+                return
+            from google.auth.transport.requests import Request
+            await asyncio.to_thread(self.credentials.refresh, Request())
+            await asyncio.to_thread(self.save_credentials)
+            logger.info(f"🔑 Access token refreshed, valid for {int(self.expires_in() or 0)}s")
+
+    async def token_refresher(self):
+        """Keep the access token fresh so uploads never refresh on their critical path"""
+        await self.wait_ready()
+        while True:
+            delay = TOKEN_REFRESH_MARGIN / 2
+            if self.connected and self.needs_refresh(TOKEN_REFRESH_MARGIN):
+                try:
+                    await self.refresh_credentials(TOKEN_REFRESH_MARGIN)
+                except Exception as e:
+                    logger.warning(f"Background token refresh failed: {e}")
+                    delay = 30
+            elif self.expires_in() is not None:
+                delay = max(30, self.expires_in() - TOKEN_REFRESH_MARGIN)
+            await asyncio.sleep(delay)
+
+    async def auth_headers(self):
+        """Bearer header for raw Drive HTTP calls, refreshing an expired token first"""
+        if self.needs_refresh():
+            await self.refresh_credentials()
+        return {'Authorization': f'Bearer {self.credentials.token}'}
+
+    async def upload_file(self, file_path, file_name, user_id=None, task_id=None, session_uri=None,
+                          progress=None):
+        """Upload file to Google Drive optimized for STB, returns (file_id, share_link, md5)"""
+        if not self.connected:
+            return None, None, None
+
+        total_size = os.path.getsize(file_path)
+        offset = 0
+
+        # Continue a session journaled before a restart
+        if session_uri:
+            committed, finished = await self.query_upload_session(session_uri, total_size)
+            if finished:
+                file_id = finished.get('id')
+                return file_id, await self.share_file(file_id), finished.get('md5Checksum')
+            if committed is None:
+                session_uri = None
+            else:
+                logger.info(f"♻️ Resuming Drive upload at byte {committed}")
+                offset = committed
 
-    def upload_file(self, file_path, file_name):
-        """Upload file to Google Drive optimized for STB"""
-        if not self.service:
-            return None, None
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return await self.upload_stream(
+                FileSource(f), file_name, total_size, user_id, task_id, session_uri, offset, progress
+            )
+
+    async def upload_stream(self, source, file_name, total_size, user_id=None, task_id=None,
+                            session_uri=None, offset=0, progress=None):
+        """Upload total_size bytes read from source via a resumable session"""
+        if not self.connected:
+            return None, None, None
 
         try:
-            mime_type = 'application/octet-stream'
-            if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
-                mime_type = 'image/jpeg'
-            elif file_name.lower().endswith('.mp4'):
-                mime_type = 'video/mp4'
-            elif file_name.lower().endswith('.pdf'):
-                mime_type = 'application/pdf'
-
-            file_metadata = {
-                'name': file_name,
-                'parents': [os.getenv('GDRIVE_FOLDER_ID', 'root')]
-            }
+            if not session_uri:
+                session_uri = await self.create_upload_session(file_name, total_size)
+                if task_id:
+                    job_journal.update(task_id, upload_uri=session_uri)
+
+            result = None
+            retries = 0
+            resent = 0
+            if not total_size:
+                # An empty file never enters the chunk loop, one empty PUT finalizes it
+                _, result = await self.query_upload_session(session_uri, 0)
+            while offset < total_size and result is None:
+                chunk = await source.read(min(UPLOAD_CHUNK_SIZE, total_size - offset))
+                if not chunk:
+                    raise Exception(f"Source stream ended at byte {offset} of {total_size}")
+
+                if THROTTLE_UPLOADS:
+                    await bandwidth_governor.consume(len(chunk), user_id)
+
+                # The chunk stays in memory until Drive has committed all of it
+                chunk_start, chunk_end = offset, offset + len(chunk)
+                sent_until = chunk_start
+                while offset < chunk_end and result is None:
+                    resent += max(0, sent_until - offset)
+                    sent_until = chunk_end
+                    status, committed, result, retry_after = await self._put_chunk(
+                        session_uri, chunk[offset - chunk_start:], offset, total_size
+                    )
+
+                    if status == 308 and committed > offset:
+                        # Drive may commit less than was sent, the rest goes out again right away
+                        offset = committed
+                        if task_id:
+                            job_journal.progress(task_id, committed)
+                        if progress:
+                            progress.update('upload', committed)
+                        logger.info(f"Upload progress: {int(committed * 100 / total_size)}%")
+                        continue
+                    if result is not None:
+                        break
+                    if isinstance(status, int) and status != 308 and status not in RETRYABLE_STATUSES:
+                        raise Exception(f"Drive upload chunk returned HTTP {status}")
+
+                    retries += 1
+                    self.upload_retries += 1
+                    if retries > UPLOAD_MAX_RETRIES:
+                        raise Exception(f"Upload retry budget exhausted at byte {offset}")
+
+                    delay = retry_after or min(UPLOAD_RETRY_MAX_DELAY, UPLOAD_RETRY_BASE * 2 ** (retries - 1))
+                    delay *= random.uniform(0.8, 1.2) if not retry_after else 1
+                    logger.warning(f"⚠️ Upload chunk at byte {offset} failed ({status}), "
+                                   f"retry {retries}/{UPLOAD_MAX_RETRIES} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+                    # Continue from whatever Drive actually kept
+                    committed, finished = await self.query_upload_session(session_uri, total_size)
+                    if finished:
+                        result = finished
+                    elif committed is not None:
+                        if committed < chunk_start:
+                            raise Exception(f"Drive rolled back to byte {committed}, chunk starts at {chunk_start}")
+                        offset = committed
+
+            if result is None:
+                raise Exception("Drive upload session did not complete")
+
+            self.resent_bytes += resent
+            if retries:
+                logger.info(f"♻️ Upload of {file_name} recovered after {retries} retries, "
+                            f"{resent/(1024*1024):.1f} MB re-sent")
+
+            if progress:
+                progress.update('upload', total_size)
+
+            file_id = result.get('id')
+            with job_tracer.span('share'):
+                share_link = await self.share_file(file_id)
+
+            logger.info(f"✅ File uploaded successfully: {file_name}")
+            return file_id, share_link, result.get('md5Checksum')
 
-            media = MediaFileUpload(
-                file_path, 
-                mimetype=mime_type,
-                resumable=True,
-                chunksize=CHUNK_SIZE * 1024
+        except Exception as e:
+            logger.error(f"Upload failed: {e}")
+            await source.abort(e)
+            return None, None, None
+
+    async def _put_chunk(self, session_uri, data, start, total_size):
+        """PUT one slice of a resumable upload
+
+        Returns (status, committed, result, retry_after); status is the
+        exception text when the request never got an HTTP response.
+        """
+        try:
+            headers = await self.auth_headers()
+            headers['Content-Range'] = f'bytes {start}-{start + len(data) - 1}/{total_size}'
+            async with get_drive_session().put(session_uri, data=data, headers=headers) as response:
+                if response.status in (200, 201, 308):
+                    metrics.inc('stb_upload_bytes_total', len(data))
+                if response.status == 308:
+                    return 308, self.parse_committed_range(response), None, None
+                if response.status in (200, 201):
+                    return response.status, total_size, await response.json(content_type=None), None
+                return response.status, None, None, self.parse_retry_after(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return str(e) or type(e).__name__, None, None, None
+
+    @staticmethod
+    def parse_retry_after(response):
+        """Seconds from a Retry-After header (delta or HTTP date), capped at five minutes"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.isdigit():
+            return min(300.0, float(value))
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+            return min(300.0, max(0.0, when.timestamp() - time.time()))
+        except (TypeError, ValueError):
+            return None
+
+    async def create_upload_session(self, file_name, total_size):
+        """Open a Drive resumable upload session and return its URI"""
+        headers = await self.auth_headers()
+        headers.update({
+            'X-Upload-Content-Type': self.get_mime_type(file_name),
+            'X-Upload-Content-Length': str(total_size)
+        })
+
+        async with get_drive_session().post(
+            DRIVE_UPLOAD_URL,
+            params={'uploadType': 'resumable', 'fields': 'id,name,size,md5Checksum'},
+            json={'name': file_name, 'parents': [os.getenv('GDRIVE_FOLDER_ID', 'root')]},
+            headers=headers
+        ) as response:
+            response.raise_for_status()
+            return response.headers['Location']
+
+    async def query_upload_session(self, session_uri, total_size):
+        """Ask Drive how much of a resumable session is committed
+
+        Returns (committed_bytes, None) while the upload is incomplete,
+        (total_size, file_metadata) once it finished, or (None, None) if
+        the session expired and the upload has to start over.
+        """
+        try:
+            headers = await self.auth_headers()
+            headers['Content-Range'] = f'bytes */{total_size}'
+
+            async with get_drive_session().put(session_uri, headers=headers) as response:
+                if response.status == 308:
+                    return self.parse_committed_range(response), None
+                if response.status in (200, 201):
+                    return total_size, await response.json(content_type=None)
+                logger.warning(f"Upload session no longer valid: HTTP {response.status}")
+        except Exception as e:
+            logger.warning(f"Could not query upload session: {e}")
+
+        return None, None
+
+    @staticmethod
+    def parse_committed_range(response):
+        """Number of bytes Drive has committed, from a 308 Range header"""
+        range_header = response.headers.get('Range')
+        if not range_header:
+            return 0
+        return int(range_header.rsplit('-', 1)[1]) + 1
+
+    async def file_exists(self, file_id):
+        """Whether a Drive file is still present and not trashed, None when Drive could not tell"""
+        try:
+            async with get_drive_session().get(
+                f"{DRIVE_API_URL}/files/{file_id}",
+                params={'fields': 'id,trashed'},
+                headers=await self.auth_headers()
+            ) as response:
+                if response.status == 404:
+                    return False
+                if response.status != 200:
+                    logger.warning(f"Could not check Drive file {file_id}: HTTP {response.status}")
+                    return None
+                return not (await response.json(content_type=None)).get('trashed', False)
+        except Exception as e:
+            logger.warning(f"Could not check Drive file {file_id}: {e}")
+            return None
+
+    async def share_file(self, file_id):
+        """Make file readable by anyone with the link
+
+        Calls arriving within PERMISSION_BATCH_WINDOW are sent to Drive as
+        one multipart batch request instead of a round trip per file.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.share_queue.append((file_id, future))
+        if len(self.share_queue) >= PERMISSION_BATCH_SIZE:
+            self.flush_shares()
+        elif not self.share_flush:
+            self.share_flush = asyncio.get_running_loop().call_later(PERMISSION_BATCH_WINDOW, self.flush_shares)
+        await future
+
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+    def flush_shares(self):
+        if self.share_flush:
+            self.share_flush.cancel()
+            self.share_flush = None
+        while self.share_queue:
+            pending, self.share_queue = self.share_queue[:PERMISSION_BATCH_SIZE], self.share_queue[PERMISSION_BATCH_SIZE:]
+            asyncio.create_task(self._send_shares(pending))
+
+    async def _send_shares(self, pending):
+        try:
+            if len(pending) == 1:
+                async with get_drive_session().post(
+                    f"{DRIVE_API_URL}/files/{pending[0][0]}/permissions",
+                    json={'type': 'anyone', 'role': 'reader'},
+                    headers=await self.auth_headers()
+                ) as response:
+                    response.raise_for_status()
+                statuses = {0: response.status}
+            else:
+                statuses = await self._batch_permissions([file_id for file_id, _ in pending])
+                logger.info(f"🔗 Shared {len(pending)} files in one Drive batch request")
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for index, (file_id, future) in enumerate(pending):
+            status = statuses.get(index)
+            if future.done():
+                continue
+            if status and 200 <= status < 300:
+                future.set_result(None)
+            else:
+                future.set_exception(Exception(f"Sharing {file_id} returned HTTP {status}"))
+
+    async def _batch_permissions(self, file_ids):
+        """POST one multipart/mixed Drive batch, returns {index: http_status}"""
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for index, file_id in enumerate(file_ids):
+            parts.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <item{index}>\r\n\r\n"
+                f"POST /drive/v3/files/{file_id}/permissions\r\n"
+                f"Content-Type: application/json\r\n\r\n"
+                f"{json.dumps({'type': 'anyone', 'role': 'reader'})}\r\n"
             )
+        body = ''.join(parts) + f"--{boundary}--\r\n"
+
+        headers = await self.auth_headers()
+        headers['Content-Type'] = f'multipart/mixed; boundary={boundary}'
+        async with get_drive_session().post(DRIVE_BATCH_URL, data=body.encode(), headers=headers) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            text = await response.text()
+
+        match = re.search(r'boundary=("?)([^";]+)\1', content_type)
+        if not match:
+            raise Exception("Drive batch response has no multipart boundary")
+
+        statuses = {}
+        for part in text.split(f"--{match.group(2)}"):
+            item = re.search(r'Content-ID:\s*<response-item(\d+)>', part, re.IGNORECASE)
+            status = re.search(r'HTTP/[\d.]+ (\d{3})', part)
+            if item and status:
+                statuses[int(item.group(1))] = int(status.group(1))
+        return statuses
+
+    async def delete_file(self, file_id):
+        """Remove a file this app uploaded, e.g. a duplicate found after streaming"""
+        async with get_drive_session().delete(
+            f"{DRIVE_API_URL}/files/{file_id}",
+            headers=await self.auth_headers()
+        ) as response:
+            if response.status not in (204, 404):
+                response.raise_for_status()
+
+    async def list_folder_checksums(self):
+        """All files in the upload folder with their Drive-computed MD5"""
+        folder_id = os.getenv('GDRIVE_FOLDER_ID', 'root')
+        params = {
+            'q': f"'{folder_id}' in parents and trashed = false",
+            'fields': 'nextPageToken,files(id,name,size,md5Checksum)',
+            'pageSize': 1000
+        }
+        files = []
+        while True:
+            async with get_drive_session().get(
+                f"{DRIVE_API_URL}/files", params=params, headers=await self.auth_headers()
+            ) as response:
+                response.raise_for_status()
+                page = await response.json(content_type=None)
+            files.extend(f for f in page.get('files', []) if f.get('md5Checksum'))
+            if not page.get('nextPageToken'):
+                return files
+            params['pageToken'] = page['nextPageToken']
+
+    @staticmethod
+    def get_mime_type(file_name):
+        mime_type = 'application/octet-stream'
+        if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+            mime_type = 'image/jpeg'
+        elif file_name.lower().endswith('.mp4'):
+            mime_type = 'video/mp4'
+        elif file_name.lower().endswith('.pdf'):
+            mime_type = 'application/pdf'
+        return mime_type
+
+_http_session = None
+_drive_session = None
+
+def get_http_session():
+    """Shared keep-alive aiohttp session living on the bot's event loop"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=HTTP_READ_TIMEOUT)
+        )
+    return _http_session
+
+def get_drive_session():
+    """Keep-alive session for Google APIs, kept apart so origin downloads cannot starve it"""
+    global _drive_session
+    if _drive_session is None or _drive_session.closed:
+        _drive_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=DRIVE_POOL_SIZE, keepalive_timeout=DRIVE_KEEPALIVE, ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=HTTP_READ_TIMEOUT)
+        )
+    return _drive_session
+
+async def close_http_session():
+    for session in (_http_session, _drive_session):
+        if session is not None and not session.closed:
+            await session.close()
+
+class TokenBucket:
+    """Token bucket measured in bytes"""
 
-            request = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id,name,size'
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def configure(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def reserve(self, amount):
+        """Take amount tokens now, return seconds to wait until the debt is repaid"""
+        if self.rate <= 0:
+            return 0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class BandwidthGovernor:
+    """Aggregate bandwidth cap shared by every transfer, with per-user sub-limits"""
+
+    def __init__(self, max_mbps=MAX_SPEED_MBPS, user_mbps=USER_MAX_SPEED_MBPS, burst_mb=SPEED_BURST_MB):
+        self.burst = int(burst_mb * 1024 * 1024)
+        self.rate_mbps = max_mbps
+        self.user_mbps = user_mbps
+        self.global_bucket = TokenBucket(self._to_bytes(max_mbps), self.burst)
+        self.user_buckets = {}
+
+    @staticmethod
+    def _to_bytes(mbps):
+        return max(0.0, mbps) * 1024 * 1024
+
+    def set_limits(self, max_mbps=None, user_mbps=None):
+        """Change limits at runtime, 0 disables the corresponding cap"""
+        if max_mbps is not None:
+            self.rate_mbps = max_mbps
+            self.global_bucket.configure(self._to_bytes(max_mbps), self.burst)
+        if user_mbps is not None:
+            self.user_mbps = user_mbps
+            for bucket in self.user_buckets.values():
+                bucket.configure(self._to_bytes(user_mbps), self.burst)
+
+        logger.info(f"⚡ Bandwidth limits: {self.rate_mbps} MB/s total, {self.user_mbps or 'no'} MB/s per user")
+
+    def _user_bucket(self, user_id):
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self._to_bytes(self.user_mbps), self.burst)
+            self.user_buckets[user_id] = bucket
+        return bucket
+
+    async def consume(self, amount, user_id=None):
+        """Wait until amount bytes fit under the global and per-user caps"""
+        wait = self.global_bucket.reserve(amount)
+        if user_id is not None and self.user_mbps > 0:
+            wait = max(wait, self._user_bucket(user_id).reserve(amount))
+        if wait > 0:
+            metrics.inc('stb_throttle_seconds_total', wait)
+            job_tracer.add('throttle', wait)
+            await asyncio.sleep(wait)
+
+class StreamBuffer:
+    """Bounded in-memory byte pipe between a download and a Drive upload"""
+
+    def __init__(self, max_bytes=STREAM_BUFFER_SIZE):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.closed = False
+        self.error = None
+        self.cond = asyncio.Condition()
+
+    async def put(self, chunk):
+        """Append chunk, waiting while the buffer is full"""
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: self.size + len(chunk) <= self.max_bytes or not self.size or self.error
             )
+            if self.error:
+                raise Exception(f"Stream aborted: {self.error}")
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.cond.notify_all()
+
+    async def read(self, n):
+        """Read exactly n bytes, or fewer once the writer has closed"""
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.size >= n or self.closed or self.error)
+            if self.error:
+                raise Exception(f"Stream aborted: {self.error}")
+
+            parts = []
+            needed = n
+            while needed and self.chunks:
+                chunk = self.chunks.popleft()
+                if len(chunk) > needed:
+                    self.chunks.appendleft(chunk[needed:])
+                    chunk = chunk[:needed]
+                parts.append(chunk)
+                needed -= len(chunk)
+
+            data = b''.join(parts)
+            self.size -= len(data)
+            self.cond.notify_all()
+            return data
+
+    async def close(self):
+        async with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    async def abort(self, error):
+        async with self.cond:
+            self.error = error
+            self.chunks.clear()
+            self.size = 0
+            self.cond.notify_all()
+
+class FileSource:
+    """Read side of a staged local file with the StreamBuffer interface"""
+
+    def __init__(self, f):
+        self.f = f
+
+    async def read(self, n):
+        # A whole upload chunk from eMMC would hold the event loop for too long
+        return await asyncio.to_thread(self.f.read, n)
+
+    async def abort(self, error):
+        pass
+
+class ContentHasher:
+    """Incremental MD5 (and optionally SHA-256) of a download, computed off the event loop
+
+    In-order bytes are fed with update() without touching the disk again.
+    Segmented downloads finish out of order, so follow_file() hashes the
+    contiguous prefix from the file instead. Segment 1 is usually still
+    cached, but later segments are only reached once segment 1 is done; on
+    large files they are read back from the eMMC, one extra read pass.
+    DOWNLOAD_SEGMENTS=1 keeps disk-staged jobs to a single pass.
+    """
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256() if HASH_SHA256 else None
+        self.offset = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def _digest(self, data):
+        self.md5.update(data)
+        if self.sha256:
+            self.sha256.update(data)
+
+    def _digest_file(self, fd, offset, end):
+        while offset < end:
+            data = os.pread(fd, min(HASH_BLOCK_SIZE, end - offset), offset)
+            if not data:
+                break
+            self._digest(data)
+            offset += len(data)
+        return offset
+
+    async def update(self, chunk):
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+        self.offset += len(chunk)
+        if self.pending_size >= HASH_BLOCK_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            await asyncio.to_thread(self._digest, data)
+
+    async def follow_file(self, fd, end):
+        """Hash file bytes from the current offset up to end"""
+        await self.flush()
+        if end > self.offset:
+            self.offset = await asyncio.to_thread(self._digest_file, fd, self.offset, end)
+
+    def reset(self):
+        """Start over, for an origin that restarted the body from byte zero"""
+        self.__init__()
+
+    async def result(self):
+        await self.flush()
+        return {
+            'md5': self.md5.hexdigest(),
+            'sha256': self.sha256.hexdigest() if self.sha256 else None,
+            'size': self.offset
+        }
+
+class DownloadInterrupted(Exception):
+    """A response body stalled or ended early, safe to continue with a Range request"""
+
+async def guarded_chunks(response):
+    """Iterate a response body, raising DownloadInterrupted on a stall
+
+    Only time spent waiting on the network counts towards the throughput
+    window, so bandwidth throttling never looks like a stalled origin.
+    The read size follows the measured rate, aiming for about
+    CHUNK_READS_PER_SECOND iterations instead of one per 8 KB.
+    """
+    size = CHUNK_SIZE
+    waited = 0.0
+    received = 0
+    rate_start = time.monotonic()
+    rate_bytes = 0
+    while True:
+        started = time.monotonic()
+        try:
+            chunk = await asyncio.wait_for(response.content.read(size), DOWNLOAD_STALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise DownloadInterrupted(f"No data for {DOWNLOAD_STALL_TIMEOUT:.0f}s")
+        if not chunk:
+            return
+
+        now = time.monotonic()
+        waited += now - started
+        received += len(chunk)
+        if waited >= DOWNLOAD_STALL_WINDOW:
+            if received / waited < DOWNLOAD_MIN_SPEED:
+                raise DownloadInterrupted(f"Throughput fell to {received / waited / 1024:.1f} KB/s")
+            waited, received = 0.0, 0
+
+        rate_bytes += len(chunk)
+        metrics.inc('stb_download_bytes_total', len(chunk))
+        if now - rate_start >= 0.5:
+            rate = rate_bytes / (now - rate_start)
+            size = int(min(CHUNK_SIZE_MAX, max(CHUNK_SIZE, rate / CHUNK_READS_PER_SECOND)))
+            rate_start, rate_bytes = now, 0
+        yield chunk
+
+class WriteBuffer:
+    """Preallocated buffer turning many network reads into one positioned write
+
+    offset is the file position everything before which is on disk, which
+    is what progress journaling and prefix hashing may rely on.
+    """
+
+    def __init__(self, fd, offset, size=WRITE_BUFFER_SIZE):
+        self.fd = fd
+        self.offset = offset
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.used = 0
+
+    def add(self, chunk):
+        """Buffer chunk, returns True when data was written to disk"""
+        flushed = False
+        if self.used + len(chunk) > len(self.buffer):
+            flushed = self.flush()
+        if len(chunk) >= len(self.buffer):
+            os.pwrite(self.fd, chunk, self.offset)
+            self.offset += len(chunk)
+            return True
+        self.view[self.used:self.used + len(chunk)] = chunk
+        self.used += len(chunk)
+        return flushed
+
+    def flush(self):
+        if not self.used:
+            return False
+        written = 0
+        while written < self.used:
+            written += os.pwrite(self.fd, self.view[written:self.used], self.offset + written)
+        self.offset += self.used
+        self.used = 0
+        return True
+
+class SegmentedDownloader:
+    """Multi-connection HTTP Range downloader for STB"""
+
+    RETRYABLE = (aiohttp.ClientError, asyncio.TimeoutError, DownloadInterrupted)
+
+    def __init__(self, segments=DOWNLOAD_SEGMENTS):
+        self.segments = max(1, segments)
+        self.retries = 0
+
+    async def probe(self, url):
+        """Check whether the origin supports byte ranges and announces a size"""
+        info = {'url': url, 'total_size': 0, 'accept_ranges': False, 'etag': None, 'last_modified': None,
+                'probed': time.monotonic()}
+        session = get_http_session()
+
+        try:
+            async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.ok:
+                    info['url'] = str(response.url)
+                    info['total_size'] = int(response.headers.get('content-length', 0) or 0)
+                    info['accept_ranges'] = response.headers.get('accept-ranges', '').lower() == 'bytes'
+                    info['etag'] = response.headers.get('etag')
+                    info['last_modified'] = response.headers.get('last-modified')
+        except Exception as e:
+            logger.warning(f"HEAD probe failed for {url}: {e}")
+
+        # Some origins reject HEAD or omit Accept-Ranges, ask for one byte instead
+        if not info['accept_ranges'] or not info['total_size']:
+            try:
+                async with session.get(info['url'], headers={'Range': 'bytes=0-0'},
+                                       timeout=aiohttp.ClientTimeout(total=30)) as response:
+                    content_range = response.headers.get('content-range', '')
+                    if response.status == 206 and '/' in content_range:
+                        total = content_range.rsplit('/', 1)[1]
+                        if total.isdigit():
+                            info['total_size'] = int(total)
+                            info['accept_ranges'] = True
+                        info['etag'] = info['etag'] or response.headers.get('etag')
+                        info['last_modified'] = info['last_modified'] or response.headers.get('last-modified')
+            except Exception as e:
+                logger.warning(f"Range probe failed for {url}: {e}")
+
+        return info
+
+    def split_ranges(self, total_size):
+        """Split total_size into inclusive (start, end) byte ranges"""
+        segments = min(self.segments, max(1, total_size // MIN_SEGMENT_SIZE))
+        segment_size = total_size // segments
+        ranges = []
+        for index in range(segments):
+            start = index * segment_size
+            end = total_size - 1 if index == segments - 1 else start + segment_size - 1
+            ranges.append((start, end))
+        return ranges
 
-            response = None
-            while response is None:
+    @staticmethod
+    def validator(info):
+        """Strongest validator for If-Range, ETag preferred over Last-Modified"""
+        return info.get('etag') or info.get('last_modified')
+
+    @staticmethod
+    def range_headers(start, end=None, validator=None):
+        headers = {'Range': f"bytes={start}-{end if end is not None else ''}"}
+        if validator:
+            headers['If-Range'] = validator
+        return headers
+
+    @staticmethod
+    def check_response(response, validator=None):
+        """Raise retryable errors for transient statuses and a hard error if the source changed"""
+        if response.status in RETRYABLE_STATUSES:
+            response.raise_for_status()
+        current = response.headers.get('etag') or response.headers.get('last-modified')
+        # Some origins answer 206 even when If-Range no longer matches
+        if validator and current and current != validator and response.status == 206:
+            raise Exception(f"Source changed during download ({validator} -> {current})")
+
+    async def with_retries(self, what, attempt):
+        """Run attempt() until it completes, backing off on transient errors
+
+        attempt() picks up from its own progress, so every retry is a Range
+        continuation rather than a restart.
+        """
+        retries = 0
+        while True:
+            try:
+                return await attempt()
+            except self.RETRYABLE as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRYABLE_STATUSES:
+                    raise
+                retries += 1
+                self.retries += 1
+                if retries > DOWNLOAD_MAX_RETRIES:
+                    raise Exception(f"{what} failed after {DOWNLOAD_MAX_RETRIES} retries: {e}")
+                delay = min(DOWNLOAD_RETRY_MAX_DELAY, DOWNLOAD_RETRY_BASE * 2 ** (retries - 1)) * random.uniform(0.8, 1.2)
+                logger.warning(f"⚠️ {what} interrupted ({e or type(e).__name__}), "
+                               f"retry {retries}/{DOWNLOAD_MAX_RETRIES} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def download(self, url, file_path, info=None, user_id=None, task_id=None, resume=None,
+                       progress=None, hasher=None):
+        """Download url into file_path, returns number of bytes written"""
+        info = info or await self.probe(url)
+        resume = resume or {}
+
+        # Journaled segment offsets are only usable with the preallocated file intact
+        ranges = []
+        if resume.get('segments') and os.path.exists(file_path) and os.path.getsize(file_path) == info['total_size']:
+            ranges = [tuple(segment) for segment in json.loads(resume['segments'])]
+            logger.info(f"♻️ Resuming segmented download from journal ({resume.get('bytes_completed', 0)} bytes done)")
+        elif info['accept_ranges'] and info['total_size']:
+            ranges = self.split_ranges(info['total_size'])
+
+        if len(ranges) > 1 or (ranges and resume.get('segments')):
+            logger.info(f"📥 Segmented download: {len(ranges)} segments, {info['total_size']} bytes")
+            return await self._download_segmented(info, file_path, ranges, user_id, task_id, progress, hasher)
+
+        start = 0
+        if resume and os.path.exists(file_path):
+            start = os.path.getsize(file_path)
+            logger.info(f"♻️ Resuming download at byte {start}")
+
+        logger.info("📥 Single-stream download (no range support or small file)")
+        return await self._download_single(
+            info['url'], file_path, user_id, task_id, start, self.validator(info), progress, hasher
+        )
+
+    async def stream(self, info, buffer, user_id=None, start=0, progress=None, hasher=None):
+        """Feed the response body into a StreamBuffer in order, returns end offset"""
+        if info['accept_ranges'] and len(self.split_ranges(info['total_size'] - start)) > 1:
+            return await self._stream_segmented(info, buffer, user_id, start, progress, hasher)
+
+        validator = self.validator(info)
+        state = {'downloaded': start}
+
+        async def attempt():
+            downloaded = state['downloaded']
+            headers = self.range_headers(downloaded, validator=validator) if downloaded else {}
+            async with get_http_session().get(info['url'], headers=headers) as response:
+                self.check_response(response, validator)
+                response.raise_for_status()
+
+                # Bytes already handed to the uploader cannot be taken back
+                if downloaded and response.status != 206:
+                    raise Exception(f"Origin cannot resume at byte {downloaded} (HTTP {response.status})")
+
+                async for chunk in guarded_chunks(response):
+                    await bandwidth_governor.consume(len(chunk), user_id)
+                    await buffer.put(chunk)
+                    if hasher:
+                        await hasher.update(chunk)
+                    state['downloaded'] += len(chunk)
+                    if progress:
+                        progress.update('download', state['downloaded'])
+
+            if info['total_size'] and state['downloaded'] < info['total_size']:
+                raise DownloadInterrupted(f"Body ended at byte {state['downloaded']}")
+
+        await self.with_retries('Streamed download', attempt)
+        await buffer.close()
+        return state['downloaded']
+
+    async def _stream_segmented(self, info, buffer, user_id=None, start=0, progress=None, hasher=None):
+        """Fetch consecutive pieces over several connections, handing them to the buffer in order
+
+        Up to `segments` pieces of STREAM_BUFFER_SIZE / segments are held in
+        memory while they wait for their turn, on top of the buffer itself.
+        """
+        total_size = info['total_size']
+        validator = self.validator(info)
+        piece_size = max(CHUNK_SIZE_MAX, STREAM_BUFFER_SIZE // self.segments)
+        state = {'downloaded': start}
+
+        async def fetch_piece(piece_start, piece_end):
+            parts = []
+            piece = {'offset': piece_start}
+
+            async def attempt():
+                async with get_http_session().get(
+                    info['url'], headers=self.range_headers(piece['offset'], piece_end, validator)
+                ) as response:
+                    self.check_response(response, validator)
+                    if response.status != 206:
+                        raise Exception(f"Range {piece['offset']}-{piece_end} got HTTP {response.status}, expected 206")
+
+                    async for chunk in guarded_chunks(response):
+                        chunk = chunk[:piece_end + 1 - piece['offset']]
+                        await bandwidth_governor.consume(len(chunk), user_id)
+                        parts.append(chunk)
+                        piece['offset'] += len(chunk)
+                        if piece['offset'] > piece_end:
+                            break
+
+                if piece['offset'] <= piece_end:
+                    raise DownloadInterrupted(f"Range ended early at byte {piece['offset']}")
+
+            await self.with_retries(f"Streamed range ending at byte {piece_end}", attempt)
+            return parts
+
+        async def deliver(task):
+            for chunk in await task:
+                await buffer.put(chunk)
+                if hasher:
+                    await hasher.update(chunk)
+                state['downloaded'] += len(chunk)
+                if progress:
+                    progress.update('download', state['downloaded'])
+
+        pending = deque()
+        try:
+            for piece_start in range(start, total_size, piece_size):
+                piece_end = min(piece_start + piece_size, total_size) - 1
+                pending.append(asyncio.create_task(fetch_piece(piece_start, piece_end)))
+                if len(pending) >= self.segments:
+                    await deliver(pending.popleft())
+            while pending:
+                await deliver(pending.popleft())
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        await buffer.close()
+        return state['downloaded']
+
+    async def _download_single(self, url, file_path, user_id=None, task_id=None, start=0, validator=None,
+                               progress=None, hasher=None):
+        state = {'downloaded': start}
+
+        async def attempt():
+            downloaded = state['downloaded']
+            headers = self.range_headers(downloaded, validator=validator) if downloaded else {}
+            async with get_http_session().get(url, headers=headers) as response:
+                self.check_response(response, validator)
+                response.raise_for_status()
+
+                if downloaded and response.status != 206:
+                    current = response.headers.get('etag') or response.headers.get('last-modified')
+                    if validator and current and current != validator:
+                        raise Exception(f"Source changed during download ({validator} -> {current})")
+                    logger.info("Origin ignored Range request, restarting download from zero")
+                    f.truncate(0)
+                    state['downloaded'] = 0
+                    if hasher:
+                        hasher.reset()
+
+                writer = WriteBuffer(f.fileno(), state['downloaded'])
                 try:
-                    status, response = request.next_chunk()
-                    if status:
-                        logger.info(f"Upload progress: {int(status.progress() * 100)}%")
-                except Exception as e:
-                    logger.error(f"Upload chunk failed: {e}")
-                    return None, None
+                    async for chunk in guarded_chunks(response):
+                        await bandwidth_governor.consume(len(chunk), user_id)
+                        if hasher:
+                            await hasher.update(chunk)
+                        if writer.add(chunk) and task_id:
+                            job_journal.progress(task_id, writer.offset)
+                        if progress:
+                            progress.update('download', writer.offset + writer.used)
+                finally:
+                    # Bytes received before an interruption are kept for the Range retry
+                    writer.flush()
+                    state['downloaded'] = writer.offset
+
+                expected = response.content_length
+                if expected is not None and state['downloaded'] < downloaded + expected and response.status == 206:
+                    raise DownloadInterrupted(f"Body ended at byte {state['downloaded']}")
+
+        with open(file_path, 'r+b' if start else 'wb') as f:
+            # A resumed file's existing prefix is hashed from disk first
+            if hasher and start:
+                await hasher.follow_file(f.fileno(), start)
+            await self.with_retries('Download', attempt)
+
+        return state['downloaded']
+
+    async def _download_segmented(self, info, file_path, ranges, user_id=None, task_id=None, progress=None,
+                                  hasher=None):
+        total_size = info['total_size']
+        # Per-segment [next_offset, end], mutated in place and journaled for resume
+        segments = [[start, end] for start, end in ranges]
+        state = {'downloaded': total_size - sum(end + 1 - start for start, end in ranges)}
+
+        # Preallocate so every segment can write at its own offset
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != total_size:
+            disk_space.preallocate(file_path, total_size)
+
+        async def fetch_segment(segment):
+            # Refuse to mix bytes from a file that changed between segments
+            validator = self.validator(info)
+
+            async def attempt():
+                start, end = segment
+                if start > end:
+                    return
+
+                async with get_http_session().get(
+                    info['url'], headers=self.range_headers(start, end, validator)
+                ) as response:
+                    self.check_response(response, validator)
+                    if response.status != 206:
+                        raise Exception(f"Segment {start}-{end} got HTTP {response.status}, expected 206")
+
+                    writer = WriteBuffer(fd, start)
+
+                    def commit():
+                        # Only flushed bytes count, the journal and prefix hasher read them back
+                        state['downloaded'] += writer.offset - segment[0]
+                        segment[0] = writer.offset
+                        if task_id:
+                            job_journal.progress(task_id, state['downloaded'], segments)
+
+                    try:
+                        async for chunk in guarded_chunks(response):
+                            remaining = end + 1 - writer.offset - writer.used
+                            if len(chunk) > remaining:
+                                chunk = chunk[:remaining]
+                            await bandwidth_governor.consume(len(chunk), user_id)
+                            if writer.add(chunk):
+                                commit()
+                            if progress:
+                                progress.update('download', state['downloaded'] + writer.used)
+                            if len(chunk) == remaining:
+                                break
+                    finally:
+                        writer.flush()
+                        commit()
+
+                    if segment[0] != end + 1:
+                        raise DownloadInterrupted(f"Segment ended early at byte {segment[0]}")
+
+            await self.with_retries(f"Segment ending at byte {segment[1]}", attempt)
+
+        def contiguous_end():
+            for next_offset, end in segments:
+                if next_offset <= end:
+                    return next_offset
+            return total_size
+
+        async def follow_prefix():
+            # Segments finish out of order, hash whatever prefix is complete.
+            # Data past segment 1 has usually left the page cache by then and is re-read from disk.
+            while hasher.offset < total_size:
+                await hasher.follow_file(fd, contiguous_end())
+                if hasher.offset < total_size:
+                    await asyncio.sleep(0.5)
+
+        fd = os.open(file_path, os.O_RDWR)
+        tasks = [asyncio.create_task(fetch_segment(segment)) for segment in segments]
+        follower = asyncio.create_task(follow_prefix()) if hasher else None
+        try:
+            await asyncio.gather(*tasks)
+            if follower:
+                await follower
+        finally:
+            if follower:
+                tasks.append(follower)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+
+        if state['downloaded'] != total_size:
+            raise Exception(f"Incomplete download: {state['downloaded']}/{total_size} bytes")
+
+        return state['downloaded']
+
+class JobJournal:
+    """Crash-safe SQLite journal of in-flight transfers"""
+
+    FINISHED = ('done', 'failed')
+
+    def __init__(self, db_path=JOURNAL_DB):
+        self.lock = threading.Lock()
+        self.last_write = {}
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                user_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued',
+                mode TEXT,
+                total_size INTEGER DEFAULT 0,
+                bytes_completed INTEGER DEFAULT 0,
+                segments TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                upload_uri TEXT,
+                created REAL,
+                updated REAL
+            )
+        """)
+
+    def _execute(self, sql, params=()):
+        try:
+            with self.lock:
+                return self.db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Job journal write failed: {e}")
+            return []
+
+    def create(self, task_id, url, file_name, user_id, chat_id, message_id):
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO jobs (task_id, url, file_name, user_id, chat_id, message_id, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (task_id, url, file_name, user_id, chat_id, message_id, now, now)
+        )
 
-            file_id = response.get('id')
+    def update(self, task_id, **fields):
+        fields['updated'] = time.time()
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        self._execute(f"UPDATE jobs SET {columns} WHERE task_id = ?", (*fields.values(), task_id))
+
+    def progress(self, task_id, bytes_completed, segments=None):
+        """Record progress, throttled to one write per JOURNAL_INTERVAL per job"""
+        now = time.monotonic()
+        if now - self.last_write.get(task_id, 0) < JOURNAL_INTERVAL:
+            return
+        self.last_write[task_id] = now
+
+        fields = {'bytes_completed': bytes_completed}
+        if segments is not None:
+            fields['segments'] = json.dumps(segments)
+        self.update(task_id, **fields)
+
+    def finish(self, task_id, status):
+        self.last_write.pop(task_id, None)
+        self.update(task_id, status=status, segments=None)
+
+    def unfinished(self):
+        placeholders = ', '.join('?' for _ in self.FINISHED)
+        rows = self._execute(
+            f"SELECT * FROM jobs WHERE status NOT IN ({placeholders}) ORDER BY created", self.FINISHED
+        )
+        return [dict(row) for row in rows]
 
-            self.service.permissions().create(
-                fileId=file_id,
-                body={'type': 'anyone', 'role': 'reader'}
-            ).execute()
+    def prune(self, max_age_days=7):
+        placeholders = ', '.join('?' for _ in self.FINISHED)
+        self._execute(
+            f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated < ?",
+            (*self.FINISHED, time.time() - max_age_days * 86400)
+        )
 
-            share_link = f"https://drive.google.com/file/d/{file_id}/view"
-            direct_link = f"https://drive.google.com/uc?id={file_id}"
+    @staticmethod
+    def same_source(job, info):
+        """Whether the origin still serves the file the job started downloading"""
+        if (job.get('total_size') or 0) != info['total_size']:
+            return False
+        if job.get('etag') and job['etag'] != info['etag']:
+            return False
+        if job.get('last_modified') and job['last_modified'] != info['last_modified']:
+            return False
+        return bool(job.get('etag') or job.get('last_modified') or job.get('total_size'))
+
+class ProgressReporter:
+    """Coalesced, rate-limited progress edits for one job status message
+
+    Transfer loops call update() as often as they like; the message is
+    edited at most once per PROGRESS_INTERVAL (and once per
+    PROGRESS_CHAT_INTERVAL across all jobs in the chat), never with
+    unchanged text, and finish() always delivers the final state.
+    """
+
+    STAGES = {
+        'queued': '⏳ **STB Download Queued**',
+        'probe': '🔍 **STB Checking Source**',
+        'download': '📥 **STB Download in Progress**',
+        'upload': '☁️ **STB Uploading to Google Drive**',
+        'stream': '🔀 **STB Streaming to Google Drive**',
+        'handoff': '📤 **STB Waiting for Upload Slot**',
+    }
+
+    chat_last_edit = {}
+
+    def __init__(self, message, file_name, total_size=0):
+        self.message = message
+        self.file_name = file_name
+        self.total_size = total_size
+        self.stage = 'probe'
+        self.counters = {'download': 0, 'upload': 0}
+        self.samples = {'download': deque(), 'upload': deque()}
+        self.queue_position = 0
+        self.waiting_for_disk = False
+        self.last_text = None
+        self.last_edit = 0
+        self.pending = None
+        self.dirty = False
+        self.closed = False
+
+    def set_queued(self, position, waiting_for_disk=False):
+        """Show the job's place in the download queue, called by the scheduler"""
+        self.queue_position = position
+        self.waiting_for_disk = waiting_for_disk
+        self.set_stage('queued')
+
+    def set_stage(self, stage, total_size=None):
+        self.stage = stage
+        if total_size is not None:
+            self.total_size = total_size
+        self._schedule(force=True)
+
+    def update(self, kind, value):
+        """Record the byte counter for 'download' or 'upload'"""
+        now = time.monotonic()
+        self.counters[kind] = value
+        samples = self.samples[kind]
+        samples.append((now, value))
+        while len(samples) > 2 and now - samples[0][0] > PROGRESS_WINDOW:
+            samples.popleft()
+        self._schedule()
+
+    def speed(self, kind):
+        samples = self.samples[kind]
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return 0
+        return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+
+    def render(self):
+        kind = 'download' if self.stage in ('queued', 'probe', 'download') else 'upload'
+        done = self.counters[kind]
+        # Streamed uploads commit in coarse chunks, the download side is smoother
+        speed = self.speed('download' if self.stage == 'stream' else kind)
+
+        lines = [self.STAGES[self.stage], '', f"📄 **File:** `{self.file_name}`"]
+        if self.stage == 'queued':
+            waiting_for = 'disk space' if self.waiting_for_disk else 'a free STB slot'
+            lines.append(f"📊 **Status:** Queue position {self.queue_position}, waiting for {waiting_for}")
+            lines.append(f"⚙️ **Running now:** {download_manager.active_count()}/{MAX_CONCURRENT}")
+            return '\n'.join(lines)
+        if self.stage == 'probe':
+            lines.append("📊 **Status:** Retrieving data")
+            return '\n'.join(lines)
+        if self.stage == 'handoff':
+            lines.append(f"📦 **Downloaded:** {self.total_size/(1024*1024):.1f} MB")
+            lines.append(f"📊 **Upload queue:** {upload_stage.queue.qsize()}/{upload_stage.queue.maxsize}")
+            return '\n'.join(lines)
+
+        if self.total_size:
+            percent = min(100.0, done * 100 / self.total_size)
+            filled = int(percent // 10)
+            lines.append(f"📊 **Progress:** [{'█' * filled}{'░' * (10 - filled)}] {percent:.1f}%")
+            lines.append(f"📦 **Done:** {done/(1024*1024):.1f} / {self.total_size/(1024*1024):.1f} MB")
+        else:
+            lines.append(f"📦 **Done:** {done/(1024*1024):.1f} MB")
+
+        if self.stage == 'stream':
+            lines.append(f"📥 **Downloaded:** {self.counters['download']/(1024*1024):.1f} MB")
+
+        lines.append(f"⚡ **Speed:** {speed/(1024*1024):.2f} MB/s")
+        if self.total_size and speed > 0:
+            eta = int((self.total_size - done) / speed)
+            lines.append(f"⏱️ **ETA:** {eta // 60}:{eta % 60:02d}")
+
+        return '\n'.join(lines)
+
+    def _schedule(self, force=False):
+        if self.closed:
+            return
+        if self.pending and not self.pending.done():
+            # A stage change during an edit is delivered right after it
+            self.dirty = self.dirty or force
+            return
+
+        now = time.monotonic()
+        if not force:
+            if now - self.last_edit < PROGRESS_INTERVAL:
+                return
+            if now - self.chat_last_edit.get(self.message.chat_id, 0) < PROGRESS_CHAT_INTERVAL:
+                return
+
+        self.pending = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        chat_id = self.message.chat_id
+        while True:
+            # Stage changes wait for the chat's edit slot instead of being dropped
+            wait = PROGRESS_CHAT_INTERVAL - (time.monotonic() - self.chat_last_edit.get(chat_id, 0))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self.closed:
+                return
+            self.dirty = False
+            self.last_edit = self.chat_last_edit[chat_id] = time.monotonic()
+
+            text = self.render()
+            if text != self.last_text:
+                self.last_text = text
+                await edit_status(self.message, text, parse_mode='Markdown')
+            if not self.dirty:
+                return
+
+    async def finish(self, text, **kwargs):
+        """Stop periodic edits and deliver the final status"""
+        self.closed = True
+        if self.pending:
+            await self.pending
+        if text != self.last_text:
+            self.last_text = text
+            await edit_status(self.message, text, **kwargs)
+
+class BatchItem:
+    """Stand-in status message for one job of a batch
+
+    ProgressReporter and process_stb_download edit it like a Telegram
+    message; the edit only updates this item's one-line summary.
+    """
+
+    DETAIL_PREFIXES = ('📊 **Progress:**', '📦 **Done:**', '📊 **Status:**', '🔗 **Link:**', '🚫 **Error:**')
+
+    def __init__(self, batch, index, file_name):
+        self.batch = batch
+        # Unique per item so the per-chat edit limit is applied by the batch, not between its items
+        self.chat_id = (batch.message.chat_id, index)
+        self.message_id = batch.message.message_id
+        self.file_name = file_name
+        self.summary = '⏳ Waiting'
+        self.state = 'pending'
+
+    def set_summary(self, summary, state=None):
+        self.summary = summary
+        if state:
+            self.state = state
+        self.batch.changed()
+
+    async def edit_text(self, text, **kwargs):
+        lines = text.splitlines()
+        emoji = lines[0].split()[0] if lines and lines[0].strip() else '🔄'
+        detail = ''
+        for line in lines:
+            if line.startswith(self.DETAIL_PREFIXES):
+                detail = line.split(':**', 1)[1].strip()
+                if line.startswith('🚫'):
+                    detail = re.sub(r'[*_`\[\]]', '', detail)
+                break
+
+        state = {'✅': 'done', '❌': 'failed'}.get(emoji)
+        self.set_summary(f"{emoji} {detail}".strip(), state)
+
+class BatchStatus:
+    """One aggregated status message for a multi-link /d batch
+
+    Item updates are coalesced and the shared message is edited at most
+    once per PROGRESS_CHAT_INTERVAL, always ending with the final state.
+    """
+
+    def __init__(self, message, file_names, ignored=0):
+        self.message = message
+        self.items = [BatchItem(self, index, name) for index, name in enumerate(file_names)]
+        self.ignored = ignored
+        self.last_text = None
+        self.dirty = False
+        self.pending = None
+
+    def render(self):
+        done = sum(item.state == 'done' for item in self.items)
+        failed = sum(item.state == 'failed' for item in self.items)
+        title = '✅ **STB Batch Completed**' if done + failed == len(self.items) else '📦 **STB Batch in Progress**'
+
+        lines = [
+            title, '',
+            f"🔗 **Links:** {len(self.items)} | ✅ {done} | ❌ {failed} | 🔄 {len(self.items) - done - failed}",
+        ]
+        if self.ignored:
+            lines.append(self.ignored_line(self.ignored).rstrip('\n'))
+        lines.append('')
+        for index, item in enumerate(self.items, 1):
+            lines.append(f"{index}. `{item.file_name}` {item.summary}")
+        return '\n'.join(lines)
 
-            logger.info(f"✅ File uploaded successfully: {file_name}")
-            return file_id, share_link
+    @staticmethod
+    def ignored_line(ignored):
+        if not ignored:
+            return ''
+        return f"⚠️ **Ignored:** {ignored} more link{'s' if ignored != 1 else ''} (limit {MAX_BATCH_URLS} per /d)\n"
+
+    def changed(self):
+        self.dirty = True
+        if not self.pending or self.pending.done():
+            self.pending = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        chat_id = self.message.chat_id
+        while self.dirty:
+            wait = PROGRESS_CHAT_INTERVAL - (time.monotonic() - ProgressReporter.chat_last_edit.get(chat_id, 0))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.dirty = False
+            ProgressReporter.chat_last_edit[chat_id] = time.monotonic()
+
+            text = self.render()
+            if text != self.last_text:
+                self.last_text = text
+                await edit_status(self.message, text, parse_mode='Markdown', disable_web_page_preview=True)
+
+class UrlResultCache:
+    """Persistent index of finished uploads keyed by normalized source URL"""
+
+    def __init__(self, db_path=URL_CACHE_DB):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS url_cache (
+                url_key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                share_link TEXT NOT NULL,
+                file_name TEXT,
+                size INTEGER DEFAULT 0,
+                etag TEXT,
+                last_modified TEXT,
+                created REAL,
+                last_hit REAL,
+                hit_count INTEGER DEFAULT 0
+            )
+        """)
+
+    def _execute(self, sql, params=()):
+        try:
+            with self.lock:
+                return self.db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"URL cache query failed: {e}")
+            return []
+
+    @staticmethod
+    def normalize(url):
+        """Canonical form: lowercase host, no default port/fragment/tracking params, sorted query"""
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        if parts.port and not (scheme, parts.port) in (('http', 80), ('https', 443)):
+            host = f"{host}:{parts.port}"
+
+        query = sorted(
+            (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not key.lower().startswith(TRACKING_PARAMS)
+        )
+        return urlunsplit((scheme, host, parts.path or '/', urlencode(query), ''))
+
+    def store(self, url, file_id, share_link, file_name, info):
+        """Remember a finished upload, only when the source has something to validate against"""
+        if not (info.get('etag') or info.get('last_modified') or info.get('total_size')):
+            return
+
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO url_cache "
+            "(url_key, url, file_id, share_link, file_name, size, etag, last_modified, created, last_hit) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.normalize(url), url, file_id, share_link, file_name, info.get('total_size') or 0,
+             info.get('etag'), info.get('last_modified'), now, now)
+        )
+        self.evict()
+
+    def evict(self):
+        """Drop entries older than URL_CACHE_MAX_AGE_DAYS, then least recently hit beyond the size cap"""
+        self._execute("DELETE FROM url_cache WHERE created < ?", (time.time() - URL_CACHE_MAX_AGE_DAYS * 86400,))
+        self._execute(
+            "DELETE FROM url_cache WHERE url_key NOT IN "
+            "(SELECT url_key FROM url_cache ORDER BY last_hit DESC LIMIT ?)",
+            (URL_CACHE_MAX_ENTRIES,)
+        )
+
+    def forget(self, url_key):
+        self._execute("DELETE FROM url_cache WHERE url_key = ?", (url_key,))
+
+    @staticmethod
+    def is_fresh(entry, current):
+        """Every validator known on both sides must match, and at least one must exist"""
+        compared = False
+        for entry_key, current_key in (('etag', 'etag'), ('last_modified', 'last_modified'), ('size', 'total_size')):
+            if entry[entry_key] and current[current_key]:
+                if entry[entry_key] != current[current_key]:
+                    return False
+                compared = True
+        return compared
+
+    async def lookup(self, url, info=None):
+        """Return a fresh cached result for url, or None
+
+        Validates against info, the caller's probe of url, or probes here
+        (HEAD with a Range GET fallback). An origin or Drive that cannot be
+        reached is a miss but keeps the entry.
+        """
+        url_key = self.normalize(url)
+        rows = self._execute("SELECT * FROM url_cache WHERE url_key = ?", (url_key,))
+        if not rows:
+            self.misses += 1
+            return None
+        entry = dict(rows[0])
+
+        current = info or await segmented_downloader.probe(url)
+        if not (current['etag'] or current['last_modified'] or current['total_size']):
+            logger.warning(f"URL cache validation failed for {url}: origin gave no validators")
+            self.misses += 1
+            return None
+
+        exists = await drive_manager.file_exists(entry['file_id']) if self.is_fresh(entry, current) else False
+        if exists is None:
+            self.misses += 1
+            return None
+        if not exists:
+            logger.info(f"🗑️ Stale URL cache entry dropped: {url_key}")
+            self.forget(url_key)
+            self.misses += 1
+            return None
+
+        self._execute(
+            "UPDATE url_cache SET last_hit = ?, hit_count = hit_count + 1 WHERE url_key = ?",
+            (time.time(), url_key)
+        )
+        self.hits += 1
+        return entry
+
+class ContentHashIndex:
+    """Persistent MD5 -> Drive file index so identical content is uploaded once
+
+    Filled from finished uploads and, on a local miss, from the Drive-side
+    md5Checksum of files already in the upload folder.
+    """
+
+    def __init__(self, db_path=URL_CACHE_DB):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.last_refresh = 0
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS content_hashes (
+                md5 TEXT PRIMARY KEY,
+                sha256 TEXT,
+                file_id TEXT NOT NULL,
+                share_link TEXT,
+                file_name TEXT,
+                size INTEGER DEFAULT 0,
+                created REAL
+            )
+        """)
+
+    def _execute(self, sql, params=()):
+        try:
+            with self.lock:
+                return self.db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Content index query failed: {e}")
+            return []
+
+    def store(self, md5, file_id, share_link, file_name, size, sha256=None):
+        if not md5:
+            return
+        self._execute(
+            "INSERT OR REPLACE INTO content_hashes "
+            "(md5, sha256, file_id, share_link, file_name, size, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (md5, sha256, file_id, share_link, file_name, size, time.time())
+        )
 
+    def forget(self, md5):
+        self._execute("DELETE FROM content_hashes WHERE md5 = ?", (md5,))
+
+    async def refresh_from_drive(self):
+        """Import Drive-computed checksums of files already in the upload folder"""
+        self.last_refresh = time.time()
+        try:
+            files = await drive_manager.list_folder_checksums()
         except Exception as e:
-            logger.error(f"Upload failed: {e}")
-            return None, None
+            logger.warning(f"Could not list Drive checksums: {e}")
+            return
+
+        for f in files:
+            # Drive-side entries get their share link on first use
+            self._execute(
+                "INSERT OR IGNORE INTO content_hashes (md5, file_id, file_name, size, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (f['md5Checksum'], f['id'], f.get('name'), int(f.get('size') or 0), time.time())
+            )
+        logger.info(f"🔎 Content index refreshed from Drive: {len(files)} files")
+
+    async def lookup(self, md5, size, exclude=None):
+        """Existing Drive file with the same content, or None"""
+        query = "SELECT * FROM content_hashes WHERE md5 = ? AND size = ? AND file_id != ?"
+        rows = self._execute(query, (md5, size, exclude or ''))
+        if not rows and time.time() - self.last_refresh > HASH_INDEX_REFRESH:
+            await self.refresh_from_drive()
+            rows = self._execute(query, (md5, size, exclude or ''))
+        if not rows:
+            self.misses += 1
+            return None
+
+        entry = dict(rows[0])
+        exists = await drive_manager.file_exists(entry['file_id'])
+        if not exists:
+            # Only a file Drive reports gone is dropped, not one it could not check
+            if exists is False:
+                self.forget(md5)
+            self.misses += 1
+            return None
+
+        if not entry['share_link']:
+            entry['share_link'] = await drive_manager.share_file(entry['file_id'])
+            self._execute("UPDATE content_hashes SET share_link = ? WHERE md5 = ?", (entry['share_link'], md5))
+
+        self.hits += 1
+        return entry
+
+class DiskSpaceGuard:
+    """Admission control for downloads staged on the STB's small eMMC
+
+    Bytes are reserved when a job is dispatched. Once its file is
+    tracked, only the reserved bytes not yet written (or preallocated)
+    count against free space, since statvfs already reports the rest as used.
+    """
+
+    def __init__(self, path=DOWNLOAD_DIR, headroom=MIN_FREE_SPACE):
+        self.path = path
+        self.headroom = headroom
+        self.reservations = {}
+        # task_id -> (file path, file size when tracking started)
+        self.files = {}
+
+    def free_bytes(self):
+        try:
+            stat = os.statvfs(self.path)
+            return stat.f_bavail * stat.f_frsize
+        except OSError:
+            return 0
+
+    @staticmethod
+    def file_size(file_path):
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def outstanding(self, task_id):
+        """Reserved bytes of a job that are not on disk yet"""
+        size = self.reservations.get(task_id, 0)
+        if task_id not in self.files:
+            return size
+        file_path, base = self.files[task_id]
+        return min(size, max(0, size - (self.file_size(file_path) - base)))
+
+    def available(self):
+        """Free space for new jobs: statvfs free minus headroom and unwritten reservations"""
+        pending = sum(self.outstanding(task_id) for task_id in self.reservations)
+        return self.free_bytes() - self.headroom - pending
+
+    def fits(self, size):
+        return not size or size <= self.available()
+
+    def fits_eventually(self, size):
+        """Whether size fits once every running job has cleaned up its file"""
+        staged = sum(self.file_size(file_path) for file_path, _ in self.files.values())
+        return not size or size <= self.free_bytes() - self.headroom + staged
+
+    def reserve(self, task_id, size):
+        if size:
+            self.reservations[task_id] = size
+
+    def track(self, task_id, file_path):
+        """Count a job's file against its reservation from now on"""
+        if task_id:
+            self.files[task_id] = (file_path, self.file_size(file_path))
+
+    def release(self, task_id):
+        self.reservations.pop(task_id, None)
+        self.files.pop(task_id, None)
+
+    def preallocate(self, file_path, size):
+        """Allocate the whole file up front: less fragmentation and an immediate ENOSPC"""
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise Exception(f"Not enough disk space for {size/(1024*1024):.1f} MB")
+                # Filesystems without fallocate fall back to a sparse file
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def needed_for(info):
+        """Bytes a job will stage on disk, 0 when it streams straight to Drive"""
+        if STREAM_UPLOADS and info.get('total_size'):
+            return 0
+        return info.get('total_size') or 0
 
 class DownloadManager:
-    """STB-optimized download manager"""
+    """STB-optimized fair-share download scheduler
+
+    Jobs wait in a bounded queue and are dispatched to MAX_CONCURRENT
+    worker tasks on the bot's event loop: owner jobs first, then
+    round-robin across users so one heavy user cannot starve everyone else.
+    Jobs whose staged file does not fit on disk yet stay queued while
+    later jobs that fit (e.g. streamed ones) go ahead.
+    """
+
+    def __init__(self, workers=MAX_CONCURRENT, max_queue=MAX_QUEUE_SIZE, max_per_user=MAX_QUEUED_PER_USER):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.priority = deque()
+        self.queues = OrderedDict()
+        self.running = {}
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        """Spawn worker tasks, must be called from the running event loop"""
+        self.tasks = [
+            asyncio.create_task(self._worker(), name=f"stb-worker-{index}")
+            for index in range(self.workers)
+        ]
 
-    def __init__(self):
-        self.active_downloads = {}
-        self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT)
+    def queued_count(self, user_id=None):
+        if user_id is None:
+            return len(self.priority) + sum(len(queue) for queue in self.queues.values())
+        return (sum(1 for job in self.priority if job['user_id'] == user_id)
+                + len(self.queues.get(user_id, ())))
+
+    def active_count(self, user_id=None):
+        return sum(1 for job in self.running.values() if user_id is None or job['user_id'] == user_id)
+
+    def can_enqueue(self, user_id, priority=False):
+        """Back-pressure check, returns (allowed, reason)"""
+        if priority:
+            return True, None
+        if self.queued_count() >= self.max_queue:
+            return False, f"STB queue is full ({self.max_queue} jobs waiting)"
+        if self.queued_count(user_id) >= self.max_per_user:
+            return False, f"You already have {self.max_per_user} jobs waiting"
+        return True, None
+
+    def submit(self, user_id, task_id, func, *args, priority=False, disk_bytes=0, progress=None):
+        """Queue a coroutine job, returns its queue position (0 = starting now) or None when full
+
+        progress is the job's ProgressReporter; it shows the queue position
+        while the job waits.
+        """
+        allowed, _ = self.can_enqueue(user_id, priority)
+        if not allowed:
+            return None
+
+        job = {'user_id': user_id, 'task_id': task_id, 'run': lambda: func(*args), 'disk_bytes': disk_bytes,
+               'submitted': time.monotonic(), 'progress': progress}
+        if priority:
+            self.priority.append(job)
+        else:
+            self.queues.setdefault(user_id, deque()).append(job)
+        self.wakeup.set()
+        self._report_positions()
+
+        return self.position(task_id)
+
+    def position(self, task_id):
+        """1-based position in dispatch order, 0 if running or unknown"""
+        idle = max(0, self.workers - len(self.running))
+        for index, job in enumerate(self._dispatch_order()):
+            if job['task_id'] == task_id:
+                return max(0, index + 1 - idle)
+        return 0
+
+    def user_jobs(self, user_id):
+        """Running task ids and (task_id, position) for queued jobs of a user"""
+        running = [task_id for task_id, job in self.running.items() if job['user_id'] == user_id]
+        idle = max(0, self.workers - len(self.running))
+        queued = [(job['task_id'], max(1, index + 1 - idle))
+                  for index, job in enumerate(self._dispatch_order()) if job['user_id'] == user_id]
+        return running, queued
+
+    def _report_positions(self):
+        """Refresh the status of every waiting job after the queue moved"""
+        idle = max(0, self.workers - len(self.running))
+        for index, job in enumerate(self._dispatch_order()):
+            position = max(0, index + 1 - idle)
+            waiting_for_disk = not disk_space.fits(job['disk_bytes'])
+            if job['progress'] and (position or waiting_for_disk):
+                job['progress'].set_queued(max(1, position), waiting_for_disk)
+
+    def _dispatch_order(self):
+        order = list(self.priority)
+        queues = [list(queue) for queue in self.queues.values()]
+        depth = max((len(queue) for queue in queues), default=0)
+        for round_index in range(depth):
+            order.extend(queue[round_index] for queue in queues if round_index < len(queue))
+        return order
+
+    def _admit(self, job):
+        if disk_space.fits(job['disk_bytes']):
+            disk_space.reserve(job['task_id'], job['disk_bytes'])
+            return True
+        if not job.get('disk_wait_logged'):
+            job['disk_wait_logged'] = True
+            logger.info(f"💾 Job {job['task_id']} waits for {job['disk_bytes']/(1024*1024):.1f} MB of disk space")
+        return False
+
+    def _next_job(self):
+        for job in self.priority:
+            if self._admit(job):
+                self.priority.remove(job)
+                return job
+
+        # Round-robin: serve the first user whose next job fits, then move them to the back
+        for user_id, queue in list(self.queues.items()):
+            if not self._admit(queue[0]):
+                continue
+            job = queue.popleft()
+            del self.queues[user_id]
+            if queue:
+                self.queues[user_id] = queue
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    # Space can also be freed outside the bot, look again now and then
+                    await asyncio.wait_for(self.wakeup.wait(), 30 if self.queued_count() else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.running[job['task_id']] = job
+            job_tracer.record(job['task_id'], 'queue', time.monotonic() - job['submitted'])
+            self._report_positions()
+            try:
+                await job['run']()
+            except Exception as e:
+                logger.error(f"Job {job['task_id']} crashed: {e}")
+            finally:
+                self.running.pop(job['task_id'], None)
+                # A handed-off file keeps its disk reservation until it is uploaded
+                if not upload_stage.owns(job['task_id']):
+                    disk_space.release(job['task_id'])
+                # Freed disk space may admit a job that was waiting
+                self.wakeup.set()
+
+class UploadStage:
+    """Upload worker pool fed by the download workers
+
+    A download worker hands its finished local file over and moves on to
+    the next download while MAX_CONCURRENT_UPLOADS workers push files to
+    Drive. The hand-off queue is bounded, so when uploads fall behind the
+    download workers wait instead of filling the disk.
+    """
+
+    def __init__(self, workers=MAX_CONCURRENT_UPLOADS, max_queue=UPLOAD_HANDOFF_QUEUE):
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.pending = {}
+        self.running = {}
+        self.tasks = []
+        self.handed_off = 0
+        self.peak_depth = 0
+        self.blocked_seconds = 0.0
+
+    def start(self):
+        """Spawn worker tasks, must be called from the running event loop"""
+        self.tasks = [
+            asyncio.create_task(self._worker(), name=f"stb-uploader-{index}")
+            for index in range(self.workers)
+        ]
 
-    def can_download(self, user_id):
-        return len(self.active_downloads.get(user_id, [])) < MAX_CONCURRENT
+    def owns(self, task_id):
+        return task_id in self.pending or task_id in self.running
 
-    def add_download(self, user_id, task_id):
-        if user_id not in self.active_downloads:
-            self.active_downloads[user_id] = []
-        self.active_downloads[user_id].append(task_id)
+    def active_count(self, user_id=None):
+        return sum(1 for job in self.running.values() if user_id is None or job['user_id'] == user_id)
 
-    def remove_download(self, user_id, task_id):
-        if user_id in self.active_downloads:
-            if task_id in self.active_downloads[user_id]:
-                self.active_downloads[user_id].remove(task_id)
-            if not self.active_downloads[user_id]:
-                del self.active_downloads[user_id]
+    def user_jobs(self, user_id):
+        return [task_id for task_id, job in {**self.pending, **self.running}.items() if job['user_id'] == user_id]
+
+    async def hand_off(self, user_id, task_id, run):
+        """Queue an upload coroutine factory, waiting while the hand-off queue is full"""
+        job = {'user_id': user_id, 'task_id': task_id, 'run': run}
+        self.pending[task_id] = job
+        started = time.monotonic()
+        try:
+            await self.queue.put(job)
+        except BaseException:
+            self.pending.pop(task_id, None)
+            raise
+        job['queued'] = time.monotonic()
+        self.blocked_seconds += job['queued'] - started
+        self.handed_off += 1
+        self.peak_depth = max(self.peak_depth, self.queue.qsize())
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            self.pending.pop(job['task_id'], None)
+            self.running[job['task_id']] = job
+            job_tracer.record(job['task_id'], 'upload_queue', time.monotonic() - job['queued'])
+            try:
+                await job['run']()
+            except Exception as e:
+                logger.error(f"Upload {job['task_id']} crashed: {e}")
+            finally:
+                self.running.pop(job['task_id'], None)
+                disk_space.release(job['task_id'])
+                download_manager.wakeup.set()
+                self.queue.task_done()
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class JobTrace:
+    """Seconds spent per stage by one job, from the /d command to its final status"""
+
+    def __init__(self, parent=None):
+        self.task_id = None
+        self.file_name = None
+        self.started = parent.started if parent else time.time()
+        self.t0 = parent.t0 if parent else time.monotonic()
+        self.spans = dict(parent.spans) if parent else {}
+        self.result = None
+        self.size = 0
+        self.total = 0.0
+
+    def add(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def speed(self):
+        return self.size / self.total if self.total else 0.0
+
+class JobTracer:
+    """Per-job stage spans kept in a bounded ring for /perf, optionally persisted
+
+    Spans also feed the stb_stage_seconds metric. Code deep inside a job
+    (throttling, permission calls) finds its trace through a context
+    variable set when the job starts on a worker.
+    """
+
+    STAGES = ('subscription', 'cache', 'admission', 'queue', 'probe', 'download', 'stream',
+              'throttle', 'handoff', 'upload_queue', 'upload', 'share')
+
+    def __init__(self, db_path=PERF_DB, size=PERF_RING_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.ring = deque(maxlen=size)
+        self.active = {}
+        self.db = None
+        if not db_path:
+            return
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS job_traces (
+                task_id TEXT,
+                file_name TEXT,
+                result TEXT,
+                size INTEGER DEFAULT 0,
+                started REAL,
+                total REAL,
+                spans TEXT
+            )
+        """)
+        for row in reversed(self._execute("SELECT * FROM job_traces ORDER BY started DESC LIMIT ?", (size,))):
+            trace = JobTrace()
+            trace.task_id, trace.file_name, trace.result = row['task_id'], row['file_name'], row['result']
+            trace.size, trace.started, trace.total = row['size'], row['started'], row['total']
+            trace.spans = json.loads(row['spans'] or '{}')
+            self.ring.append(trace)
+
+    def _execute(self, sql, params=()):
+        try:
+            with self.lock:
+                return self.db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Trace store query failed: {e}")
+            return []
+
+    def attach(self, task_id, file_name, trace=None):
+        """Register the trace of a submitted job"""
+        trace = trace or JobTrace()
+        trace.task_id, trace.file_name = task_id, file_name
+        self.active[task_id] = trace
+        return trace
+
+    def enter(self, task_id, file_name):
+        """Make the job's trace current on this worker, resumed jobs get a fresh one"""
+        trace = self.active.get(task_id) or self.attach(task_id, file_name)
+        current_trace.set(trace)
+        return trace
+
+    def discard(self, task_id):
+        self.active.pop(task_id, None)
+
+    def record(self, task_id, stage, seconds):
+        metrics.observe('stb_stage_seconds', seconds, stage=stage)
+        trace = self.active.get(task_id)
+        if trace:
+            trace.add(stage, seconds)
+
+    def add(self, stage, seconds):
+        """Account time to the current job without a metric sample, e.g. many short sleeps"""
+        trace = current_trace.get()
+        if trace:
+            trace.add(stage, seconds)
+
+    @contextlib.contextmanager
+    def span(self, stage, trace=None):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.observe('stb_stage_seconds', elapsed, stage=stage)
+            trace = trace or current_trace.get()
+            if trace:
+                trace.add(stage, elapsed)
+
+    def finish(self, task_id, result, size=0):
+        trace = self.active.pop(task_id, None)
+        if not trace:
+            return
+        trace.result, trace.size = result, size
+        trace.total = time.monotonic() - trace.t0
+        self.ring.append(trace)
+
+        if self.db:
+            self._execute(
+                "INSERT INTO job_traces (task_id, file_name, result, size, started, total, spans) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task_id, trace.file_name, result, size, trace.started, trace.total, json.dumps(trace.spans))
+            )
+            self._execute(
+                "DELETE FROM job_traces WHERE rowid NOT IN "
+                "(SELECT rowid FROM job_traces ORDER BY started DESC LIMIT ?)",
+                (self.size,)
+            )
+
+    @staticmethod
+    def percentile(values, fraction):
+        """Nearest-rank percentile of a sorted list"""
+        return values[max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))]
+
+    def stage_stats(self):
+        """{stage: (p50, p95, jobs)} over the ring, in pipeline order"""
+        durations = {}
+        for trace in self.ring:
+            for stage, seconds in trace.spans.items():
+                durations.setdefault(stage, []).append(seconds)
+
+        stats = {}
+        for stage in self.STAGES + tuple(sorted(set(durations) - set(self.STAGES))):
+            values = sorted(durations.get(stage, ()))
+            if values:
+                stats[stage] = (self.percentile(values, 0.5), self.percentile(values, 0.95), len(values))
+        return stats
+
+    def slowest(self, count=5):
+        return sorted(self.ring, key=lambda trace: trace.total, reverse=True)[:count]
+
+class MetricsServer:
+    """Embedded HTTP endpoint: /metrics for Prometheus, /healthz for the container healthcheck"""
+
+    def __init__(self, port=METRICS_PORT):
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/healthz', self.handle_healthz)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, '0.0.0.0', self.port).start()
+            logger.info(f"📈 Metrics endpoint listening on port {self.port}")
+        except OSError as e:
+            logger.warning(f"Metrics endpoint disabled, port {self.port} unavailable: {e}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    @staticmethod
+    def gauges():
+        snapshot = stb_info.latest()
+        return [
+            ('stb_jobs_active', 'Jobs currently running per stage', [
+                ({'stage': 'download'}, download_manager.active_count()),
+                ({'stage': 'upload'}, upload_stage.active_count()),
+            ]),
+            ('stb_jobs_queued', 'Jobs waiting per stage', [
+                ({'stage': 'download'}, download_manager.queued_count()),
+                ({'stage': 'upload'}, upload_stage.queue.qsize()),
+            ]),
+            ('stb_subscription_cache_requests_total', 'Subscription check cache lookups', [
+                ({'result': 'hit'}, subscription_cache.hits),
+                ({'result': 'miss'}, subscription_cache.misses),
+            ]),
+            ('stb_subscription_cache_hit_ratio', 'Subscription check cache hit rate',
+             [({}, subscription_cache.hit_rate())]),
+            ('stb_url_cache_requests_total', 'URL result cache lookups', [
+                ({'result': 'hit'}, url_cache.hits),
+                ({'result': 'miss'}, url_cache.misses),
+            ]),
+            ('stb_dedup_requests_total', 'Content hash index lookups', [
+                ({'result': 'hit'}, content_index.hits),
+                ({'result': 'miss'}, content_index.misses),
+            ]),
+            ('stb_download_retries_total', 'Download reconnects', [({}, segmented_downloader.retries)]),
+            ('stb_upload_retries_total', 'Drive upload chunk retries', [({}, drive_manager.upload_retries)]),
+            ('stb_drive_connected', 'Whether Google Drive credentials are loaded', [({}, int(drive_manager.connected))]),
+            ('stb_temperature_celsius', 'SoC temperature', [({}, snapshot['temperature'])]),
+            ('stb_load_average', 'System load average', [
+                ({'period': period}, value) for period, value in zip(('1m', '5m', '15m'), snapshot['load'])
+            ]),
+            ('stb_memory_available_bytes', 'MemAvailable from /proc/meminfo', [({}, snapshot['mem_available'])]),
+            ('stb_disk_free_bytes', 'Free space on the download volume', [({}, disk_space.free_bytes())]),
+        ]
+
+    async def handle_metrics(self, request):
+        return web.Response(text=metrics.render(self.gauges()), content_type='text/plain', charset='utf-8')
+
+    @staticmethod
+    def health():
+        """(healthy, checks); a Drive that was never connected is reported but not fatal"""
+        poll_age = time.monotonic() - InstrumentedRequest.last_poll
+        expires_in = drive_manager.expires_in() if drive_manager.connected else None
+        checks = {
+            'polling': poll_age <= HEALTH_POLL_MAX_AGE,
+            'poll_age_seconds': round(poll_age, 1),
+            'drive_connected': drive_manager.connected,
+            # The refresher renews well before expiry, an expired token means it keeps failing
+            'drive_token': expires_in is None or expires_in > 0,
+        }
+        return checks['polling'] and checks['drive_token'], checks
+
+    async def handle_healthz(self, request):
+        healthy, checks = self.health()
+        return web.json_response(checks, status=200 if healthy else 503)
 
 # Global instances
+metrics = MetricsRegistry()
+metrics_server = MetricsServer()
+job_tracer = JobTracer()
+subscription_cache = SubscriptionCache()
 drive_manager = GoogleDriveManager()
 download_manager = DownloadManager()
+upload_stage = UploadStage()
+disk_space = DiskSpaceGuard()
+segmented_downloader = SegmentedDownloader()
+bandwidth_governor = BandwidthGovernor()
+job_journal = JobJournal()
+url_cache = UrlResultCache()
+content_index = ContentHashIndex()
 stb_info = STBSystemInfo()
 
 # Helper functions
 def is_owner(username):
     return username and username.lower() == OWNER_USERNAME.lower()
 
+def sparkline(values, width=20):
+    """Compact block-character chart of the most recent values"""
+    values = values[-width:]
+    low, high = min(values), max(values)
+    blocks = '▁▂▃▄▅▆▇█'
+    if high - low < 1e-9:
+        return blocks[0] * len(values)
+    return ''.join(blocks[int((value - low) / (high - low) * (len(blocks) - 1))] for value in values)
+
+def extract_urls(text):
+    """Distinct http(s) links in text, in order"""
+    urls = []
+    for url in re.findall(r'https?://\S+', text or ''):
+        url = url.rstrip('.,;:!?)>]\'"')
+        if url not in urls:
+            urls.append(url)
+    return urls
+
 def extract_args(text, command):
     """Extract arguments from command or reply"""
     # Handle @username commands
@@ -440,7 +2921,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     owner_note = ""
     if is_owner(user.username):
-        owner_note = "\n\n🔧 **Owner Access Granted**\nAdvanced STB management available"
+        owner_note = "\n\n🔧 **Owner Access Granted**\nAdvanced STB management available\n/speed [MB/s] [user MB/s] - Change bandwidth limits\n/perf - Stage timings and slowest jobs"
 
     message = f"""
 🎉 Welcome {user.first_name}!
@@ -469,7 +2950,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • ARM64 optimized downloads
 • Automatic Google Drive upload
 • Concurrent processing ({MAX_CONCURRENT} files)
-• Speed optimization ({MAX_SPEED_MBPS} MB/s)
+• Speed optimization ({bandwidth_governor.rate_mbps} MB/s)
 • Channel subscription protection
 
 💡 **Inline Usage:**
@@ -546,7 +3027,8 @@ async def auth_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if drive_manager.service:
+    await drive_manager.wait_ready()
+    if drive_manager.connected:
         await update.message.reply_text(
             "✅ **Already Connected to Google Drive**\n\n"
             "Your Google Drive is active and ready.\n"
@@ -554,7 +3036,7 @@ async def auth_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    auth_url, error = drive_manager.get_auth_url()
+    auth_url, error = await asyncio.to_thread(drive_manager.get_auth_url)
     if error:
         await update.message.reply_text(f"❌ **Connection Error**\n\n{error}")
         return
@@ -605,7 +3087,8 @@ async def code_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     msg = await update.message.reply_text("🔄 **Processing STB Authentication...**")
 
-    success, error = drive_manager.authenticate_with_code(auth_code)
+    # fetch_token is a blocking network call, keep it off the transfer loop
+    success, error = await asyncio.to_thread(drive_manager.authenticate_with_code, auth_code)
 
     if success:
         await msg.edit_text(
@@ -627,49 +3110,46 @@ async def code_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """STB-optimized download and upload command with multiple input methods"""
+    trace = JobTrace()
+
     # Check channel subscription
-    if not await check_subscription(update, context):
-        return
+    with job_tracer.span('subscription', trace):
+        if not await check_subscription(update, context):
+            return
 
-    # Extract URL from different sources
-    url = None
+    # Extract URLs from different sources
+    urls = []
 
     # Method 1: From command arguments
     if context.args:
-        url = context.args[0]
+        urls = extract_urls(' '.join(context.args))
 
     # Method 2: From replied message
     elif update.message.reply_to_message:
-        replied_text = update.message.reply_to_message.text
-        if replied_text and (replied_text.startswith('http') or 'http' in replied_text):
-            # Extract URL from replied message
-            words = replied_text.split()
-            for word in words:
-                if word.startswith('http'):
-                    url = word
-                    break
+        replied = update.message.reply_to_message
+        urls = extract_urls(replied.text or replied.caption)
 
     # Method 3: From inline usage (@username command)
     elif update.message.text:
         text = update.message.text
         # Check for @username pattern
         if f'@{BOT_USERNAME}' in text:
-            args = extract_args(text, f'/d@{BOT_USERNAME}')
-            if args:
-                url = args
+            urls = extract_urls(extract_args(text, f'/d@{BOT_USERNAME}'))
 
-    if not url:
+    if not urls:
         await update.message.reply_text(
             "⚠️ **Invalid Format**\n\n"
             "**Usage Options:**\n"
             "• `/d [file-link]`\n"
             f"• `/d@{BOT_USERNAME} [file-link]`\n"
-            "• Reply to message with link using `/d`\n\n"
+            "• Reply to message with link using `/d`\n"
+            f"• Several links at once (up to {MAX_BATCH_URLS})\n\n"
             "**Example:** `/d https://example.com/file.zip`"
         )
         return
 
-    if not drive_manager.service:
+    await drive_manager.wait_ready()
+    if not drive_manager.connected:
         await update.message.reply_text(
             "🔐 **Google Drive Not Connected**\n\n"
             "Connect your Google Drive first using /auth\n"
@@ -677,109 +3157,459 @@ async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    user_id = update.effective_user.id
-    if not download_manager.can_download(user_id):
-        active = len(download_manager.active_downloads.get(user_id, []))
-        await update.message.reply_text(
-            f"📊 **STB Queue Limit Reached**\n\n"
-            f"Active processes: {active}/{MAX_CONCURRENT}\n"
-            f"STB can handle {MAX_CONCURRENT} concurrent downloads"
-        )
-        return
+    # Links past the batch limit are reported in the batch status, not queued
+    ignored = max(0, len(urls) - MAX_BATCH_URLS)
+    urls = urls[:MAX_BATCH_URLS]
 
+    if len(urls) > 1 or ignored:
+        await batch_download(update, urls, trace, ignored)
+        return
+    url = urls[0]
+    user_id = update.effective_user.id
+    priority = is_owner(update.effective_user.username)
     file_name = url.split('/')[-1] or f"stb_download_{int(time.time())}"
-    task_id = f"stb_{user_id}_{int(time.time())}"
-
-    download_manager.add_download(user_id, task_id)
+    task_id = f"stb_{uuid.uuid4().hex}"
 
     system_info = stb_info.get_system_info()
     msg = await update.message.reply_text(
         f"📥 **STB Download Starting**\n\n"
         f"📄 **File:** `{file_name}`\n"
         f"🏗️ **STB Arch:** {system_info['architecture']}\n"
-        f"⚡ **Speed:** Up to {MAX_SPEED_MBPS} MB/s\n"
+        f"⚡ **Speed:** Up to {bandwidth_governor.rate_mbps} MB/s\n"
         f"💾 **Available:** {system_info['storage_available']}\n"
-        f"🔄 **Status:** Initializing...",
+        f"🔄 **Status:** Checking file...",
         parse_mode='Markdown'
     )
 
-    # Process download in background
-    download_manager.executor.submit(
-        process_stb_download, url, file_name, user_id, task_id, msg
-    )
+    # One probe serves both cache validation and disk admission
+    with job_tracer.span('admission', trace):
+        info = await segmented_downloader.probe(url)
 
-def process_stb_download(url, file_name, user_id, task_id, message):
-    """STB-optimized download and upload process"""
-    file_path = f"/app/downloads/{file_name}"
+    # Popular links that are already on Drive are answered without moving bytes
+    with job_tracer.span('cache', trace):
+        cached = await url_cache.lookup(url, info)
+    if cached:
+        await msg.edit_text(
+            f"⚡ **STB Cache Hit!**\n\n"
+            f"📄 **File:** `{cached['file_name']}`\n"
+            f"📦 **Size:** {(cached['size'] or 0)/(1024*1024):.1f} MB\n"
+            f"🔗 **Link:** [Open File]({cached['share_link']})\n\n"
+            f"♻️ Already on Google Drive, no transfer needed",
+            parse_mode='Markdown'
+        )
+        return
 
-    try:
-        asyncio.create_task(message.edit_text(
-            f"📥 **STB Download in Progress**\n\n"
+    allowed, reason = download_manager.can_enqueue(user_id, priority)
+    if not allowed:
+        await msg.edit_text(
+            f"📊 **STB Queue Full**\n\n"
             f"📄 **File:** `{file_name}`\n"
-            f"🌐 **Source:** Processing...\n"
-            f"🏗️ **STB:** ARM64 optimized download\n"
-            f"📊 **Status:** Retrieving data",
-            parse_mode='Markdown'
-        ))
+            f"{reason}\n"
+            f"Active processes: {download_manager.active_count()}/{MAX_CONCURRENT}\n"
+            f"Please try again in a few minutes"
+        )
+        return
 
-        response = requests.get(url, stream=True, timeout=300)
-        response.raise_for_status()
+    # Files staged on disk must fit the eMMC, at least once running jobs are done
+    disk_bytes = DiskSpaceGuard.needed_for(info)
+    if not disk_space.fits_eventually(disk_bytes):
+        await msg.edit_text(
+            f"💾 **Not Enough STB Storage**\n\n"
+            f"📄 **File:** `{file_name}`\n"
+            f"This file needs {disk_bytes/(1024*1024):.1f} MB on disk\n"
+            f"Free for downloads: {max(0, disk_space.available())/(1024*1024):.1f} MB",
+            parse_mode='Markdown'
+        )
+        return
 
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
+    job_journal.create(task_id, url, file_name, user_id, update.effective_chat.id, msg.message_id)
+    job_tracer.attach(task_id, file_name, trace)
 
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    time.sleep(CHUNK_SIZE / (MAX_SPEED_MBPS * 1024 * 1024))
+    # Process download in background, the scheduler keeps the queue position up to date
+    progress = ProgressReporter(msg, file_name)
+    position = download_manager.submit(
+        user_id, task_id, process_stb_download, url, file_name, user_id, task_id, msg, None, info, progress,
+        priority=priority, disk_bytes=disk_bytes, progress=progress
+    )
 
-        asyncio.create_task(message.edit_text(
-            f"☁️ **STB Uploading to Google Drive**\n\n"
+    if position is None:
+        job_journal.finish(task_id, 'failed')
+        job_tracer.discard(task_id)
+        await msg.edit_text(
+            f"📊 **STB Queue Full**\n\n"
             f"📄 **File:** `{file_name}`\n"
-            f"📦 **Size:** {downloaded/(1024*1024):.1f} MB\n"
-            f"🏗️ **STB:** ARM64 upload optimization\n"
-            f"🔄 **Status:** Transferring to Drive",
+            f"Please try again in a few minutes",
             parse_mode='Markdown'
-        ))
+        )
 
-        file_id, share_link = drive_manager.upload_file(file_path, file_name)
+async def batch_download(update: Update, urls, trace=None, ignored=0):
+    """Enqueue several links as one batch reported in a single status message
 
-        if file_id and share_link:
-            try:
-                os.remove(file_path)
-            except:
-                pass
-
-            asyncio.create_task(message.edit_text(
-                f"✅ **STB Process Completed!**\n\n"
-                f"📄 **File:** `{file_name}`\n"
-                f"📦 **Size:** {downloaded/(1024*1024):.1f} MB\n"
-                f"🏗️ **STB:** HG680P ARM64\n"
-                f"🔗 **Link:** [Open File]({share_link})\n\n"
-                f"🗑️ **Local cleanup completed** ✅",
-                parse_mode='Markdown'
-            ))
-        else:
-            raise Exception("Google Drive upload failed")
+    ignored is the number of links dropped for exceeding MAX_BATCH_URLS.
+    """
+    user_id = update.effective_user.id
+    priority = is_owner(update.effective_user.username)
+    stamp = int(time.time())
+
+    msg = await update.message.reply_text(
+        f"📦 **STB Batch Starting**\n\n"
+        f"🔗 **Links:** {len(urls)}\n"
+        f"{BatchStatus.ignored_line(ignored)}"
+        f"🔄 **Status:** Checking links...",
+        parse_mode='Markdown'
+    )
+    batch = BatchStatus(
+        msg, [url.split('/')[-1] or f"stb_download_{stamp}_{index}" for index, url in enumerate(urls)], ignored
+    )
+
+    # One probe per link serves both cache validation and disk admission
+    with job_tracer.span('admission', trace):
+        probes = await asyncio.gather(*(segmented_downloader.probe(url) for url in urls))
+    with job_tracer.span('cache', trace):
+        cached_results = await asyncio.gather(*(url_cache.lookup(url, info) for url, info in zip(urls, probes)))
+
+    for url, item, cached, info in zip(urls, batch.items, cached_results, probes):
+        if cached:
+            item.set_summary(f"⚡ [Open File]({cached['share_link']})", 'done')
+            continue
+
+        disk_bytes = DiskSpaceGuard.needed_for(info)
+        if not disk_space.fits_eventually(disk_bytes):
+            item.set_summary(f"💾 Needs {disk_bytes/(1024*1024):.1f} MB, not enough STB storage", 'failed')
+            continue
+
+        allowed, reason = download_manager.can_enqueue(user_id, priority)
+        if not allowed:
+            item.set_summary(f"⚠️ {reason}", 'failed')
+            continue
+
+        task_id = f"stb_{uuid.uuid4().hex}"
+        job_journal.create(task_id, url, item.file_name, user_id, update.effective_chat.id, msg.message_id)
+        # Items share the batch's checks, each gets its own copy of those spans
+        job_tracer.attach(task_id, item.file_name, JobTrace(trace))
+        progress = ProgressReporter(item, item.file_name)
+        position = download_manager.submit(
+            user_id, task_id, process_stb_download, url, item.file_name, user_id, task_id, item, None, info,
+            progress, priority=priority, disk_bytes=disk_bytes, progress=progress
+        )
 
+        if position is None:
+            job_journal.finish(task_id, 'failed')
+            job_tracer.discard(task_id)
+            item.set_summary("⚠️ STB queue is full", 'failed')
+
+    batch.changed()
+
+async def edit_status(message, text, **kwargs):
+    """Edit a job status message, ignoring harmless Telegram errors"""
+    try:
+        await message.edit_text(text, **kwargs)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            logger.warning(f"Status edit failed: {e}")
     except Exception as e:
+        logger.warning(f"Status edit failed: {e}")
+
+async def stream_to_drive(info, file_name, user_id=None, task_id=None, resume=None, progress=None, hasher=None):
+    """Pipe a download with known size into a Drive resumable upload
+
+    Returns (downloaded, file_id, share_link, drive_md5); hasher is only
+    fed when the whole body passes through this process.
+    """
+    total_size = info['total_size']
+    session_uri = None
+    offset = 0
+
+    # Pick up a journaled upload session at the byte Drive last committed
+    if resume and resume.get('upload_uri'):
+        committed, finished = await drive_manager.query_upload_session(resume['upload_uri'], total_size)
+        if finished:
+            file_id = finished.get('id')
+            return total_size, file_id, await drive_manager.share_file(file_id), finished.get('md5Checksum')
+        if committed is not None:
+            session_uri, offset = resume['upload_uri'], committed
+            logger.info(f"♻️ Resuming streamed upload at byte {offset}")
+
+    buffer = StreamBuffer()
+    uploader = asyncio.create_task(drive_manager.upload_stream(
+        buffer, file_name, total_size, user_id, task_id, session_uri, offset, progress
+    ))
+
+    try:
+        downloaded = await segmented_downloader.stream(
+            info, buffer, user_id, offset, progress, hasher if not offset else None
+        )
+    except BaseException as e:
+        await buffer.abort(e)
+        raise
+    finally:
+        file_id, share_link, drive_md5 = await uploader
+
+    return downloaded, file_id, share_link, drive_md5
+
+def staging_path(task_id, file_name):
+    """Per-job local path, so jobs for files with the same name never share one"""
+    return os.path.join(DOWNLOAD_DIR, f"{task_id}_{file_name}")
+
+async def process_stb_download(url, file_name, user_id, task_id, message, resume=None, info=None, progress=None):
+    """STB-optimized download and upload process
+
+    Runs on a download worker. Streamed jobs finish here; a disk-staged
+    file is handed to upload_stage so this worker can start the next download.
+    info is the admission probe of a new job; it is reused only if it is
+    younger than PROBE_MAX_AGE, queued and resumed jobs probe again.
+    progress is the reporter that showed the job's queue position.
+    """
+    file_path = staging_path(task_id, file_name)
+    progress = progress or ProgressReporter(message, file_name)
+    hasher = ContentHasher()
+    trace = job_tracer.enter(task_id, file_name)
+
+    async def complete(mode, downloaded, digest, file_id, share_link, drive_md5, duplicate=None):
+        if file_id and digest and drive_md5 and digest['md5'] != drive_md5:
+            await drive_manager.delete_file(file_id)
+            raise Exception(f"Checksum mismatch: downloaded {digest['md5']}, Drive has {drive_md5}")
+
+        md5 = drive_md5 or (digest['md5'] if digest else None)
+
+        # Streamed bytes are already in Drive, so a duplicate is removed afterwards
+        if mode == 'stream' and file_id and md5:
+            duplicate = await content_index.lookup(md5, downloaded, exclude=file_id)
+            if duplicate:
+                await drive_manager.delete_file(file_id)
+
+        dedup_line = ''
+        if duplicate:
+            file_id, share_link = duplicate['file_id'], duplicate['share_link']
+            dedup_line = "♻️ **Dedup:** Same content already in Drive\n"
+            logger.info(f"♻️ Duplicate content of {duplicate['file_name']}, linked existing Drive file")
+        elif file_id:
+            content_index.store(md5, file_id, share_link, file_name, downloaded,
+                                digest['sha256'] if digest else None)
+
+        if not (file_id and share_link):
+            raise Exception("Google Drive upload failed")
+
+        job_journal.finish(task_id, 'done')
+        metrics.inc('stb_jobs_total', result='duplicate' if duplicate else 'done')
+        job_tracer.finish(task_id, 'duplicate' if duplicate else 'done', downloaded)
+        url_cache.store(url, file_id, share_link, file_name, info)
+
+        try:
+            os.remove(file_path)
+        except:
+            pass
+
+        await progress.finish(
+            f"✅ **STB Process Completed!**\n\n"
+            f"📄 **File:** `{file_name}`\n"
+            f"📦 **Size:** {downloaded/(1024*1024):.1f} MB\n"
+            f"🏗️ **STB:** HG680P ARM64\n"
+            f"🔗 **Link:** [Open File]({share_link})\n"
+            f"{dedup_line}\n"
+            f"🗑️ **Local cleanup completed** ✅",
+            parse_mode='Markdown'
+        )
+
+    async def fail(e):
+        job_journal.finish(task_id, 'failed')
+        metrics.inc('stb_jobs_total', result='failed')
+        job_tracer.finish(task_id, 'failed')
+
         try:
             if os.path.exists(file_path):
                 os.remove(file_path)
         except:
             pass
 
-        asyncio.create_task(message.edit_text(
+        await progress.finish(
             f"❌ **STB Process Failed**\n\n"
             f"📄 **File:** `{file_name}`\n"
             f"🚫 **Error:** {str(e)[:100]}...\n"
             f"🏗️ **STB:** Check connection and try again"
-        ))
+        )
 
-    finally:
-        download_manager.remove_download(user_id, task_id)
+    async def upload(downloaded, digest):
+        """Upload stage of a disk-staged file, runs on an upload worker"""
+        current_trace.set(trace)
+        try:
+            progress.set_stage('upload', downloaded)
+            with job_tracer.span('upload'):
+                file_id, share_link, drive_md5 = await drive_manager.upload_file(
+                    file_path, file_name, user_id, task_id, resume.get('upload_uri') if resume else None, progress
+                )
+            await complete('disk', downloaded, digest, file_id, share_link, drive_md5)
+        except Exception as e:
+            await fail(e)
+
+    try:
+        if info is None or time.monotonic() - info['probed'] > PROBE_MAX_AGE:
+            progress.set_stage('probe')
+            with job_tracer.span('probe'):
+                info = await segmented_downloader.probe(url)
+
+        if resume and resume.get('mode') and not job_journal.same_source(resume, info):
+            logger.info(f"Source of {task_id} changed since it was journaled, starting over")
+            resume = None
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+        if resume and resume.get('mode'):
+            mode = resume['mode']
+        else:
+            mode = 'stream' if STREAM_UPLOADS and info['total_size'] else 'disk'
+            job_journal.update(
+                task_id, status='downloading', mode=mode, total_size=info['total_size'],
+                etag=info['etag'], last_modified=info['last_modified'],
+                bytes_completed=0, segments=None, upload_uri=None
+            )
+
+        if mode == 'stream':
+            # Zero-disk mode: download and Drive upload overlap through memory
+            progress.set_stage('stream', info['total_size'])
+            with job_tracer.span('stream'):
+                downloaded, file_id, share_link, drive_md5 = await stream_to_drive(
+                    info, file_name, user_id, task_id, resume, progress, hasher
+                )
+            digest = await hasher.result() if hasher.offset == downloaded else None
+            await complete(mode, downloaded, digest, file_id, share_link, drive_md5)
+            return
+
+        digest = duplicate = None
+        if resume and resume['status'] == 'uploading' and os.path.exists(file_path):
+            downloaded = os.path.getsize(file_path)
+        else:
+            progress.set_stage('download', info['total_size'])
+            disk_space.track(task_id, file_path)
+            with job_tracer.span('download'):
+                downloaded = await segmented_downloader.download(
+                    url, file_path, info, user_id, task_id, resume, progress, hasher
+                )
+            job_journal.update(task_id, status='uploading', bytes_completed=downloaded, segments=None)
+            digest = await hasher.result()
+            duplicate = await content_index.lookup(digest['md5'], downloaded)
+
+        if duplicate:
+            await complete(mode, downloaded, digest, None, None, None, duplicate)
+        else:
+            progress.set_stage('handoff', downloaded)
+            with job_tracer.span('handoff'):
+                await upload_stage.hand_off(user_id, task_id, lambda: upload(downloaded, digest))
+
+    except Exception as e:
+        await fail(e)
+
+async def resume_journaled_jobs(application: Application):
+    """Resume transfers interrupted by a restart or OOM kill"""
+    await drive_manager.wait_ready()
+    job_journal.prune()
+
+    for job in job_journal.unfinished():
+        task_id = job['task_id']
+        try:
+            message = await application.bot.send_message(
+                job['chat_id'],
+                f"♻️ **STB Resuming Download**\n\n"
+                f"📄 **File:** `{job['file_name']}`\n"
+                f"📦 **Done:** {(job['bytes_completed'] or 0)/(1024*1024):.1f} MB\n"
+                f"🔄 **Status:** Continuing after restart",
+                parse_mode='Markdown',
+                reply_to_message_id=job['message_id'],
+                allow_sending_without_reply=True
+            )
+        except Exception as e:
+            logger.warning(f"Could not resume {task_id}: {e}")
+            job_journal.finish(task_id, 'failed')
+            continue
+
+        logger.info(f"♻️ Resuming journaled job {task_id}")
+        job_journal.update(task_id, message_id=message.message_id)
+        # Bytes already on disk hold their space, only the rest is reserved
+        file_path = staging_path(task_id, job['file_name'])
+        disk_bytes = 0
+        if job['mode'] == 'disk' and job['total_size']:
+            on_disk = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            disk_bytes = max(0, job['total_size'] - on_disk)
+        # Interrupted work goes ahead of new submissions
+        progress = ProgressReporter(message, job['file_name'])
+        download_manager.submit(
+            job['user_id'], task_id, process_stb_download,
+            job['url'], job['file_name'], job['user_id'], task_id, message, job, None, progress,
+            priority=True, disk_bytes=disk_bytes, progress=progress
+        )
+
+async def post_init(application: Application):
+    """Start the transfer engine on the bot's event loop"""
+    download_manager.start()
+    upload_stage.start()
+    stb_info.start()
+    drive_manager.start()
+    await metrics_server.start()
+    # Resuming needs Drive credentials, run it in the background so polling starts immediately
+    application.bot_data['resume_task'] = asyncio.create_task(resume_journaled_jobs(application))
+
+async def post_shutdown(application: Application):
+    await metrics_server.stop()
+    await close_http_session()
+
+async def speed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Owner-only runtime bandwidth limit control"""
+    if not is_owner(update.effective_user.username):
+        await update.message.reply_text("🔒 **Owner Only**\n\nThis command is restricted to the STB owner.")
+        return
+
+    if context.args:
+        try:
+            max_mbps = float(context.args[0])
+            user_mbps = float(context.args[1]) if len(context.args) > 1 else None
+            if max_mbps < 0 or (user_mbps is not None and user_mbps < 0):
+                raise ValueError("negative limit")
+        except ValueError:
+            await update.message.reply_text(
+                "⚠️ **Invalid Format**\n\n"
+                "Please use: `/speed [total MB/s] [per-user MB/s]`\n"
+                "Use 0 to disable a limit",
+                parse_mode='Markdown'
+            )
+            return
+
+        bandwidth_governor.set_limits(max_mbps, user_mbps)
+
+    await update.message.reply_text(
+        f"⚡ **STB Bandwidth Limits**\n\n"
+        f"📊 **Total:** {bandwidth_governor.rate_mbps or 'Unlimited'} MB/s\n"
+        f"👤 **Per user:** {bandwidth_governor.user_mbps or 'Unlimited'} MB/s\n"
+        f"💥 **Burst:** {SPEED_BURST_MB} MB\n"
+        f"☁️ **Uploads throttled:** {'Yes' if THROTTLE_UPLOADS else 'No'}",
+        parse_mode='Markdown'
+    )
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Owner-only per-stage timing report from recent job traces"""
+    if not is_owner(update.effective_user.username):
+        await update.message.reply_text("🔒 **Owner Only**\n\nThis command is restricted to the STB owner.")
+        return
+
+    if not job_tracer.ring:
+        await update.message.reply_text("📈 **STB Performance**\n\nNo finished jobs traced yet.")
+        return
+
+    message = f"📈 **STB Performance (last {len(job_tracer.ring)} jobs)**\n\n"
+    message += "⏱️ **Stage p50 / p95:**\n"
+    for stage, (p50, p95, jobs) in job_tracer.stage_stats().items():
+        message += f"• `{stage}`: {p50:.2f}s / {p95:.2f}s ({jobs} jobs)\n"
+
+    message += "\n🐢 **Slowest jobs:**\n"
+    for trace in job_tracer.slowest():
+        icon = '❌' if trace.result == 'failed' else '✅'
+        stage, seconds = max(trace.spans.items(), key=lambda span: span[1], default=('-', 0.0))
+        message += (f"{icon} `{trace.file_name}` {trace.total:.1f}s, "
+                    f"{trace.size/(1024*1024):.1f} MB at {trace.speed()/(1024*1024):.2f} MB/s "
+                    f"(most in `{stage}` {seconds:.1f}s)\n")
+
+    message += "\n💡 throttle overlaps download/stream, share is part of upload/stream"
+
+    await update.message.reply_text(message, parse_mode='Markdown')
 
 async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """STB system information command"""
@@ -788,21 +3618,22 @@ async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     system_info = stb_info.get_system_info()
-
-    try:
-        uptime = subprocess.run(['uptime'], capture_output=True, text=True)
-        uptime_str = uptime.stdout.strip() if uptime.returncode == 0 else "Unknown"
-
-        temp_cmd = subprocess.run(['cat', '/sys/class/thermal/thermal_zone0/temp'], 
-                                 capture_output=True, text=True)
-        temp = int(temp_cmd.stdout.strip()) / 1000 if temp_cmd.returncode == 0 else 0
-
-        load_avg = os.getloadavg() if hasattr(os, 'getloadavg') else (0, 0, 0)
-
-    except Exception as e:
-        uptime_str = "Unknown"
-        temp = 0
-        load_avg = (0, 0, 0)
+    uptime_str = system_info['uptime']
+    temp = system_info['temperature']
+    load_avg = system_info['load']
+
+    history = stb_info.history()
+    if len(history) > 1:
+        loads = [snapshot['load'][0] for snapshot in history]
+        temps = [snapshot['temperature'] for snapshot in history]
+        minutes = max(1, round((history[-1]['time'] - history[0]['time']) / 60))
+        history_str = (
+            f"• Last {minutes} min load: {min(loads):.2f} min / {sum(loads)/len(loads):.2f} avg / {max(loads):.2f} max\n"
+            f"• Last {minutes} min temp: {min(temps):.1f}°C min / {max(temps):.1f}°C max\n"
+            f"• Load trend: {sparkline(loads)}"
+        )
+    else:
+        history_str = "• History: collecting samples..."
 
     message = f"""
 💻 **STB HG680P System Information**
@@ -824,12 +3655,16 @@ async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 **Performance:**
 • Load Average: {load_avg[0]:.2f}, {load_avg[1]:.2f}, {load_avg[2]:.2f}
 • Uptime: {uptime_str}
+{history_str}
 
 🤖 **Bot Status:**
-• Max Downloads: {MAX_CONCURRENT}
-• Speed Limit: {MAX_SPEED_MBPS} MB/s
-• Chunk Size: {CHUNK_SIZE} bytes
-• Drive Connected: {"✅ Yes" if drive_manager.service else "❌ No"}
+• Max Downloads: {MAX_CONCURRENT} (queue {download_manager.queued_count()}/{MAX_QUEUE_SIZE})
+• Max Uploads: {MAX_CONCURRENT_UPLOADS} (hand-off queue {upload_stage.queue.qsize()}/{UPLOAD_HANDOFF_QUEUE})
+• Speed Limit: {bandwidth_governor.rate_mbps} MB/s total, {bandwidth_governor.user_mbps or 'no'} MB/s per user
+• Chunk Size: {CHUNK_SIZE // 1024}-{CHUNK_SIZE_MAX // 1024} KB adaptive
+• Download Segments: {DOWNLOAD_SEGMENTS}
+• Streaming Uploads: {"✅ On" if STREAM_UPLOADS else "❌ Off"} ({STREAM_BUFFER_SIZE // (1024 * 1024)} MB buffer)
+• Drive Connected: {"✅ Yes" if drive_manager.connected else "❌ No"}
 
 🌐 **Network:**
 • Interface: eth0/wlan0
@@ -848,7 +3683,8 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    user_downloads = download_manager.active_downloads.get(user.id, [])
+    running, queued = download_manager.user_jobs(user.id)
+    running += upload_stage.user_jobs(user.id)
     system_info = stb_info.get_system_info()
 
     message = f"📊 **STB Bot Statistics - {user.first_name}**\n\n"
@@ -857,12 +3693,19 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message += f"🆔 **Channel ID:** {CHANNEL_ID}\n\n"
 
     message += f"🏗️ **STB HG680P Status:**\n"
-    message += f"📊 Active processes: {len(user_downloads)}/{MAX_CONCURRENT}\n"
-    message += f"⚡ Speed allocation: {MAX_SPEED_MBPS} MB/s\n"
+    message += f"📊 Your active processes: {len(running)}\n"
+    if queued:
+        positions = ', '.join(f"#{position}" for _, position in queued)
+        message += f"⏳ Your queued jobs: {len(queued)} (positions {positions})\n"
+    message += f"⚙️ STB slots in use: {download_manager.active_count()}/{MAX_CONCURRENT}\n"
+    message += f"📥 STB queue: {download_manager.queued_count()}/{MAX_QUEUE_SIZE}\n"
+    message += (f"☁️ Upload slots in use: {upload_stage.active_count()}/{MAX_CONCURRENT_UPLOADS} "
+                f"(waiting {upload_stage.queue.qsize()}/{UPLOAD_HANDOFF_QUEUE})\n")
+    message += f"⚡ Speed allocation: {bandwidth_governor.rate_mbps} MB/s\n"
     message += f"🧠 Memory: {system_info['memory']}\n"
     message += f"💾 Storage free: {system_info['storage_available']}\n\n"
 
-    if drive_manager.service:
+    if drive_manager.connected:
         message += f"☁️ **Google Drive:** ✅ Connected & Active\n"
     else:
         message += f"☁️ **Google Drive:** ❌ Not connected (use /auth)\n"
@@ -875,21 +3718,31 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_owner(user.username):
         message += f"\n🔧 **Owner Access:** Active\n"
         message += f"⚙️ **STB Management:** Available\n"
+        message += (f"📢 **Subscription cache:** {subscription_cache.hits} hits / "
+                    f"{subscription_cache.misses} misses ({subscription_cache.hit_rate():.0%}), "
+                    f"{len(subscription_cache.entries)} users\n")
+        message += f"🔗 **URL cache:** {url_cache.hits} hits / {url_cache.misses} misses\n"
+        message += f"♻️ **Dedup:** {content_index.hits} hits / {content_index.misses} misses\n"
+        message += (f"🔁 **Upload retries:** {drive_manager.upload_retries} "
+                    f"({drive_manager.resent_bytes/(1024*1024):.1f} MB re-sent)\n")
+        message += f"🔁 **Download retries:** {segmented_downloader.retries}\n"
+        message += (f"📤 **Upload hand-offs:** {upload_stage.handed_off} "
+                    f"(peak queue {upload_stage.peak_depth}, downloads blocked {upload_stage.blocked_seconds:.0f}s)\n")
 
     message += f"\n💡 **Must stay subscribed to {REQUIRED_CHANNEL}**"
 
     await update.message.reply_text(message, parse_mode='Markdown')
 
 # Inline query handler
-async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle inline queries"""
-    query = update.inline_query.query.lower().strip()
-    user_id = update.inline_query.from_user.id
+class InlineResults:
+    """Prebuilt inline query answers
 
-    # Check channel subscription for inline usage
-    if not await ChannelSubscriptionCheck.is_user_subscribed(context, user_id):
-        # Return subscription required result
-        results = [
+    Help and usage results never change, so they are built once. The
+    system card is rebuilt at most every INLINE_SYSTEM_TTL seconds.
+    """
+
+    def __init__(self):
+        self.subscription_required = [
             InlineQueryResultArticle(
                 id='subscription_required',
                 title=f'📢 Join {REQUIRED_CHANNEL} Required',
@@ -900,14 +3753,8 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             )
         ]
-        await update.inline_query.answer(results)
-        return
-
-    results = []
 
-    # Help command
-    if query.startswith('help') or query == '':
-        results.append(
+        self.help = [
             InlineQueryResultArticle(
                 id='help',
                 title='📋 STB Bot Help',
@@ -931,46 +3778,9 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='Markdown'
                 )
             )
-        )
-
-    # Download command
-    elif query.startswith('download '):
-        url = query[9:].strip()  # Remove 'download ' prefix
-        if url:
-            results.append(
-                InlineQueryResultArticle(
-                    id='download',
-                    title=f'📥 Download: {url}',
-                    description='Download and upload to Google Drive',
-                    input_message_content=InputTextMessageContent(
-                        message_text=f"/d {url}",
-                        parse_mode='Markdown'
-                    )
-                )
-            )
-
-    # System info
-    elif query.startswith('system'):
-        system_info = stb_info.get_system_info()
-        results.append(
-            InlineQueryResultArticle(
-                id='system',
-                title='💻 STB System Info',
-                description=f"Architecture: {system_info['architecture']}, Memory: {system_info['memory']}",
-                input_message_content=InputTextMessageContent(
-                    message_text=f"""💻 **STB HG680P Info**
-🏗️ **Arch:** {system_info['architecture']}
-🧠 **Memory:** {system_info['memory']}
-💾 **Storage:** {system_info['storage_available']} free
-📢 **Channel:** {REQUIRED_CHANNEL} ✅""",
-                    parse_mode='Markdown'
-                )
-            )
-        )
+        ]
 
-    # If no specific query, show general options
-    if not results:
-        results = [
+        self.general_help = [
             InlineQueryResultArticle(
                 id='general_help',
                 title='📋 STB Bot Commands',
@@ -989,7 +3799,133 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         ]
 
-    await update.inline_query.answer(results)
+        self.system_results = None
+        self.system_expires = 0
+        self.latest_query = {}
+
+    def system(self):
+        now = time.monotonic()
+        if self.system_results is None or now >= self.system_expires:
+            system_info = stb_info.get_system_info()
+            self.system_results = [
+                InlineQueryResultArticle(
+                    id='system',
+                    title='💻 STB System Info',
+                    description=f"Architecture: {system_info['architecture']}, Memory: {system_info['memory']}",
+                    input_message_content=InputTextMessageContent(
+                        message_text=f"""💻 **STB HG680P Info**
+🏗️ **Arch:** {system_info['architecture']}
+🧠 **Memory:** {system_info['memory']}
+💾 **Storage:** {system_info['storage_available']} free
+📢 **Channel:** {REQUIRED_CHANNEL} ✅""",
+                        parse_mode='Markdown'
+                    )
+                )
+            ]
+            self.system_expires = now + INLINE_SYSTEM_TTL
+        return self.system_results
+
+    @staticmethod
+    def download(url):
+        return [
+            InlineQueryResultArticle(
+                id='download',
+                title=f'📥 Download: {url}',
+                description='Download and upload to Google Drive',
+                input_message_content=InputTextMessageContent(
+                    message_text=f"/d {url}",
+                    parse_mode='Markdown'
+                )
+            )
+        ]
+
+    def for_query(self, query):
+        """Return (results, cache_time) for a subscribed user's query"""
+        command = query.lower()
+
+        if command.startswith('help') or command == '':
+            return self.help, INLINE_CACHE_TIME
+
+        if command.startswith('download '):
+            url = query[9:].strip()  # Remove 'download ' prefix
+            if url:
+                return self.download(url), INLINE_CACHE_TIME
+
+        if command.startswith('system'):
+            return self.system(), INLINE_SYSTEM_TTL
+
+        # If no specific query, show general options
+        return self.general_help, INLINE_CACHE_TIME
+
+    async def is_superseded(self, user_id, query_id):
+        """Debounce: wait briefly and report whether the user typed again meanwhile"""
+        self.latest_query[user_id] = query_id
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if self.latest_query.get(user_id) != query_id:
+            return True
+        del self.latest_query[user_id]
+        return False
+
+inline_results = InlineResults()
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline queries"""
+    inline = update.inline_query
+    query = inline.query.strip()
+    user_id = inline.from_user.id
+
+    # Rapid keystrokes: only the last query in a burst gets answered
+    if await inline_results.is_superseded(user_id, inline.id):
+        return
+
+    # Check channel subscription for inline usage
+    if not await ChannelSubscriptionCheck.is_user_subscribed(context, user_id):
+        await inline.answer(inline_results.subscription_required,
+                            cache_time=SUBSCRIPTION_NEGATIVE_TTL, is_personal=True)
+        return
+
+    results, cache_time = inline_results.for_query(query)
+    # Personal caching keeps the subscription gate in front of cached answers
+    await inline.answer(results, cache_time=cache_time, is_personal=True)
+
+def build_application(base_url=None):
+    """Telegram application with all handlers; base_url points it at another Bot API server"""
+    builder = Application.builder().token(BOT_TOKEN)
+    if base_url:
+        builder = builder.base_url(base_url)
+
+    # Create Telegram application with integrated credentials
+    app = (
+        builder
+        # Instrumented transports feed Bot API latency metrics and the polling health check
+        .request(InstrumentedRequest(
+            connection_pool_size=256, connect_timeout=60, read_timeout=60, write_timeout=60, pool_timeout=60
+        ))
+        .get_updates_request(InstrumentedRequest())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Add command handlers
+    app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("auth", auth_command))
+    app.add_handler(CommandHandler("code", code_command))
+    # Non-blocking: cache lookups and origin probes must not hold up other users' updates
+    app.add_handler(CommandHandler("d", download_command, block=False))
+    app.add_handler(CommandHandler("system", system_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("speed", speed_command))
+    app.add_handler(CommandHandler("perf", perf_command))
+
+    # Add inline query handler
+    # Non-blocking so the keystroke debounce does not stall other updates
+    app.add_handler(InlineQueryHandler(inline_query, block=False))
+
+    # Channel join/leave updates keep the subscription cache fresh (bot must be channel admin)
+    app.add_handler(ChatMemberHandler(channel_member_update, ChatMemberHandler.CHAT_MEMBER))
+    return app
 
 def main():
     """Main bot function with integrated credentials"""
@@ -1011,27 +3947,14 @@ def main():
     logger.info(f"⚡ Speed limit: {MAX_SPEED_MBPS} MB/s")
     logger.info(f"📊 Concurrent limit: {MAX_CONCURRENT}")
 
-    # Create Telegram application with integrated credentials
-    app = Application.builder().token(BOT_TOKEN).connect_timeout(60).read_timeout(60).write_timeout(60).pool_timeout(60).build()
-
-    # Add command handlers
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("auth", auth_command))
-    app.add_handler(CommandHandler("code", code_command))
-    app.add_handler(CommandHandler("d", download_command))
-    app.add_handler(CommandHandler("system", system_command))
-    app.add_handler(CommandHandler("stats", stats_command))
-
-    # Add inline query handler
-    app.add_handler(InlineQueryHandler(inline_query))
+    app = build_application()
 
     logger.info("✅ STB Bot initialization complete with integrated credentials!")
     logger.info("🔗 Ready for CLI operation on HG680P")
     logger.info("📢 Channel subscription required for all users")
 
     # Start the bot
-    app.run_polling(drop_pending_updates=True)
+    app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+STB download hot-loop microbenchmark
+
+Compares CPU time per MB of the old 8 KB read/write loop with the current
+adaptive-read, batched-write loop against a local origin.
+
+Usage (inside the container):
+    python /app/scripts/bench_download_loop.py [size_mb] [rounds]
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# /app/scripts in the container, scripts/ next to app/ in the repo
+for candidate in (os.path.join(SCRIPT_DIR, '..', 'app'), os.path.join(SCRIPT_DIR, '..')):
+    if os.path.exists(os.path.join(candidate, 'bot.py')):
+        sys.path.insert(0, os.path.abspath(candidate))
+        break
+
+import aiohttp
+from aiohttp import web
+
+import bot
+
+PORT = 18990
+
+def run_origin(size):
+    """Serve size random bytes from a separate process so its CPU is not measured"""
+    data = os.urandom(size)
+
+    async def handler(request):
+        return web.Response(body=data, headers={'Accept-Ranges': 'bytes'})
+
+    app = web.Application()
+    app.router.add_get('/file.bin', handler)
+    web.run_app(app, host='127.0.0.1', port=PORT, print=None, access_log=None)
+
+async def legacy_loop(url, path):
+    """The previous hot loop: fixed 8 KB reads, one write and bookkeeping per chunk"""
+    downloaded = 0
+    async with bot.get_http_session().get(url) as response:
+        with open(path, 'wb') as f:
+            async for chunk in response.content.iter_chunked(8192):
+                await bot.bandwidth_governor.consume(len(chunk))
+                f.write(chunk)
+                downloaded += len(chunk)
+    return downloaded
+
+async def current_loop(url, path):
+    return await bot.segmented_downloader._download_single(url, path)
+
+async def measure(name, loop_func, url, path, rounds):
+    results = []
+    for _ in range(rounds):
+        cpu, wall = time.process_time(), time.perf_counter()
+        size = await loop_func(url, path)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        results.append((cpu, wall, size))
+
+    # Best round, the STB is noisy
+    cpu, wall, size = min(results)
+    mb = size / (1024 * 1024)
+    print(f"{name:8} {cpu * 1000 / mb:8.2f} ms CPU/MB  {mb / wall:8.1f} MB/s wall")
+    return cpu / mb
+
+async def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    origin = multiprocessing.Process(target=run_origin, args=(size_mb * 1024 * 1024,), daemon=True)
+    origin.start()
+
+    url = f'http://127.0.0.1:{PORT}/file.bin'
+    for _ in range(50):
+        try:
+            async with bot.get_http_session().head(url):
+                break
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.2)
+
+    # Measure the loops, not the token bucket
+    bot.bandwidth_governor.set_limits(0, 0)
+
+    print(f"📊 {size_mb} MB x {rounds} rounds, chunk {bot.CHUNK_SIZE // 1024}-{bot.CHUNK_SIZE_MAX // 1024} KB, "
+          f"write buffer {bot.WRITE_BUFFER_SIZE // 1024} KB")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.bin')
+        before = await measure('before', legacy_loop, url, path, rounds)
+        after = await measure('after', current_loop, url, path, rounds)
+    print(f"⚡ CPU per MB reduced by {(1 - after / before) * 100:.0f}%")
+
+    await bot.close_http_session()
+    origin.terminate()
+
+if __name__ == '__main__':
+    asyncio.run(main())
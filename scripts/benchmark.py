@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+STB transfer pipeline benchmark
+
+Runs fully offline: a local origin (Range support, injectable latency,
+stalls, errors and dropped connections) and a local stand-in for the
+Drive resumable-upload, permission and batch endpoints run in child
+processes, and jobs go through the real download_manager /
+process_stb_download / upload_file path.
+
+Reports throughput, CPU seconds per GB, peak RSS and job latency
+percentiles per scenario and saves them as JSON. Pass --compare with an
+earlier result file to flag regressions (exit code 1).
+
+Tuning knobs are the bot's own environment variables, e.g.:
+    MAX_SPEED_MBPS=0 CHUNK_SIZE=131072 python /app/scripts/benchmark.py --sizes 16,128
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# /app/scripts in the container, scripts/ next to app/ in the repo
+for candidate in (os.path.join(SCRIPT_DIR, '..', 'app'), os.path.join(SCRIPT_DIR, '..')):
+    if os.path.exists(os.path.join(candidate, 'bot.py')):
+        APP_DIR = os.path.abspath(candidate)
+        break
+
+ORIGIN_PORT = 18991
+DRIVE_PORT = 18992
+BASE_BLOCK = random.Random(2024).randbytes(1024 * 1024)
+SEND_SIZE = 256 * 1024
+
+def file_slice(name, start, end):
+    """Bytes [start, end) of a synthetic file; the first 16 bytes make every name unique"""
+    header = hashlib.md5(name.encode()).digest()
+    position = start
+    while position < end:
+        offset = position % len(BASE_BLOCK)
+        length = min(end - position, len(BASE_BLOCK) - offset, SEND_SIZE)
+        chunk = BASE_BLOCK[offset:offset + length]
+        if position < len(header):
+            chunk = bytearray(chunk)
+            for index in range(position, min(len(header), position + length)):
+                chunk[index - position] = header[index]
+            chunk = bytes(chunk)
+        yield chunk
+        position += length
+
+def run_origin(port, latency, error_rate, stall_rate, stall_seconds, drop_rate):
+    """Origin serving /files/<name>?size=N with injected faults"""
+    from aiohttp import web
+
+    faults = random.Random(7)
+
+    async def handler(request):
+        name = request.match_info['name']
+        size = int(request.query.get('size', 0))
+        if latency:
+            await asyncio.sleep(latency)
+        if faults.random() < error_rate:
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        start, end, status = 0, size, 200
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            status = 206
+
+        response = web.StreamResponse(status=status, headers={
+            'Accept-Ranges': 'bytes',
+            'ETag': f'"{name}-{size}"',
+            'Content-Length': str(end - start),
+        })
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        stall_at = start + (end - start) // 2 if faults.random() < stall_rate else None
+        drop_at = start + (end - start) // 3 if faults.random() < drop_rate else None
+        position = start
+        try:
+            for chunk in file_slice(name, start, end):
+                if drop_at is not None and position >= drop_at:
+                    request.transport.close()
+                    return response
+                if stall_at is not None and position >= stall_at:
+                    stall_at = None
+                    await asyncio.sleep(stall_seconds)
+                await response.write(chunk)
+                position += len(chunk)
+            await response.write_eof()
+        except ConnectionResetError:
+            # The bot gave up on this connection, e.g. after a stall
+            pass
+        return response
+
+    app = web.Application()
+    app.router.add_get('/files/{name}', handler)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+def run_drive(port, latency, error_rate, ingest_mbps):
+    """Stand-in for Drive resumable uploads, permissions, batch, list and delete"""
+    from aiohttp import web
+
+    faults = random.Random(11)
+    sessions = {}
+    files = {}
+
+    async def create_session(request):
+        body = await request.json()
+        session_id = uuid.uuid4().hex
+        sessions[session_id] = {
+            'name': body.get('name'), 'total': int(request.headers['X-Upload-Content-Length']),
+            'committed': 0, 'md5': hashlib.md5(),
+        }
+        return web.Response(headers={'Location': f'http://127.0.0.1:{port}/upload/session/{session_id}'})
+
+    def committed_response(session):
+        headers = {'Range': f"bytes=0-{session['committed'] - 1}"} if session['committed'] else {}
+        return web.Response(status=308, headers=headers)
+
+    async def put_chunk(request):
+        session = sessions.get(request.match_info['session_id'])
+        if session is None:
+            return web.Response(status=404)
+        data = await request.read()
+        if latency:
+            await asyncio.sleep(latency)
+        if ingest_mbps:
+            await asyncio.sleep(len(data) / (ingest_mbps * 1024 * 1024))
+        if data and faults.random() < error_rate:
+            return web.Response(status=503)
+
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)', request.headers.get('Content-Range', ''))
+        if match and int(match.group(1)) == session['committed']:
+            session['md5'].update(data)
+            session['committed'] += len(data)
+
+        if session['committed'] < session['total']:
+            return committed_response(session)
+
+        file_id = f"bench{len(files) + 1}"
+        files[file_id] = {
+            'id': file_id, 'name': session['name'], 'size': str(session['total']),
+            'md5Checksum': session['md5'].hexdigest(),
+        }
+        return web.json_response(files[file_id])
+
+    async def permission(request):
+        if latency:
+            await asyncio.sleep(latency)
+        return web.json_response({'id': 'anyoneWithLink'})
+
+    async def batch(request):
+        body = await request.text()
+        if latency:
+            await asyncio.sleep(latency)
+        items = re.findall(r'Content-ID: <item(\d+)>', body)
+        parts = ''.join(
+            f"--response\r\nContent-Type: application/http\r\nContent-ID: <response-item{item}>\r\n\r\n"
+            f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{{}}\r\n"
+            for item in items
+        )
+        return web.Response(body=(parts + "--response--\r\n").encode(),
+                            headers={'Content-Type': 'multipart/mixed; boundary=response'})
+
+    async def list_files(request):
+        return web.json_response({'files': []})
+
+    async def get_file(request):
+        file_id = request.match_info['file_id']
+        if file_id not in files:
+            return web.Response(status=404)
+        return web.json_response({**files[file_id], 'trashed': False})
+
+    async def delete_file(request):
+        files.pop(request.match_info['file_id'], None)
+        return web.Response(status=204)
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post('/upload', create_session)
+    app.router.add_put('/upload/session/{session_id}', put_chunk)
+    app.router.add_post('/api/files/{file_id}/permissions', permission)
+    app.router.add_get('/api/files', list_files)
+    app.router.add_get('/api/files/{file_id}', get_file)
+    app.router.add_delete('/api/files/{file_id}', delete_file)
+    app.router.add_post('/batch', batch)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+class StubMessage:
+    """Status message stand-in, counts the edits a job would send to Telegram"""
+
+    chat_id = 0
+    message_id = 0
+    edits = 0
+
+    async def edit_text(self, text, **kwargs):
+        StubMessage.edits += 1
+
+class RssSampler:
+    """Peak resident set size of this process, sampled from /proc/self/statm"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.task = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return 0
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self.task.cancel()
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda fraction: values[max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))]
+    return {'p50': round(pick(0.5), 3), 'p95': round(pick(0.95), 3),
+            'p99': round(pick(0.99), 3), 'max': round(values[-1], 3)}
+
+async def wait_for(url):
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(url) as response:
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    raise SystemExit(f"Benchmark server at {url} did not start")
+
+def reset_bot_state(bot):
+    """Fresh traces and counters so each scenario reports only its own jobs"""
+    bot.job_tracer = bot.JobTracer(db_path='')
+    bot.segmented_downloader.retries = 0
+    bot.drive_manager.upload_retries = 0
+    bot.drive_manager.resent_bytes = 0
+    StubMessage.edits = 0
+
+async def run_pipeline(bot, mode, size, jobs, scenario_id):
+    """Submit jobs the way /d does and wait until every trace has finished"""
+    bot.STREAM_UPLOADS = mode == 'stream'
+    for index in range(jobs):
+        name = f"{scenario_id}-{index}.bin"
+        task_id = f"bench_{scenario_id}_{index}"
+        url = f"http://127.0.0.1:{ORIGIN_PORT}/files/{name}?size={size}"
+        bot.job_journal.create(task_id, url, name, index, 0, 0)
+        bot.job_tracer.attach(task_id, name)
+        bot.download_manager.submit(
+            index, task_id, bot.process_stb_download, url, name, index, task_id, StubMessage(), priority=True
+        )
+
+    while len(bot.job_tracer.ring) < jobs:
+        await asyncio.sleep(0.05)
+    return [(trace.total, trace.result != 'failed', trace.size) for trace in bot.job_tracer.ring]
+
+async def run_uploads(bot, size, jobs, scenario_id, workdir):
+    """Upload pre-written local files with upload_file, MAX_CONCURRENT_UPLOADS at a time"""
+    paths = []
+    for index in range(jobs):
+        path = os.path.join(workdir, f"{scenario_id}-{index}.bin")
+        with open(path, 'wb') as f:
+            for chunk in file_slice(path, 0, size):
+                f.write(chunk)
+        paths.append(path)
+
+    slots = asyncio.Semaphore(bot.MAX_CONCURRENT_UPLOADS)
+
+    async def upload(path):
+        async with slots:
+            started = time.monotonic()
+            file_id, share_link, md5 = await bot.drive_manager.upload_file(path, os.path.basename(path))
+            return time.monotonic() - started, bool(file_id and share_link), size
+
+    try:
+        return await asyncio.gather(*(upload(path) for path in paths))
+    finally:
+        for path in paths:
+            os.remove(path)
+
+async def run_scenario(bot, mode, size_mb, jobs, workdir):
+    reset_bot_state(bot)
+    scenario_id = f"{mode}-{size_mb}-{uuid.uuid4().hex[:6]}"
+    size = size_mb * 1024 * 1024
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    with RssSampler() as rss:
+        if mode == 'upload':
+            results = await run_uploads(bot, size, jobs, scenario_id, workdir)
+        else:
+            results = await run_pipeline(bot, mode, size, jobs, scenario_id)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    transferred = sum(done for _, ok, done in results if ok)
+    gigabytes = transferred / 1024 ** 3
+    stages = {stage: {'p50': round(p50, 3), 'p95': round(p95, 3)}
+              for stage, (p50, p95, _) in bot.job_tracer.stage_stats().items()}
+    return {
+        'mode': mode,
+        'size_mb': size_mb,
+        'jobs': jobs,
+        'ok': sum(1 for _, ok, _ in results if ok),
+        'failed': sum(1 for _, ok, _ in results if not ok),
+        'wall_s': round(wall, 3),
+        'bytes': transferred,
+        'throughput_mbps': round(transferred / (1024 * 1024) / wall, 2) if wall else 0,
+        'cpu_s': round(cpu, 3),
+        'cpu_s_per_gb': round(cpu / gigabytes, 2) if gigabytes else None,
+        'peak_rss_mb': round(rss.peak / (1024 * 1024), 1),
+        'latency_s': percentiles([seconds for seconds, _, _ in results]),
+        'stages_s': stages,
+        'status_edits': StubMessage.edits,
+        'retries': {
+            'download': bot.segmented_downloader.retries,
+            'upload': bot.drive_manager.upload_retries,
+            'resent_mb': round(bot.drive_manager.resent_bytes / (1024 * 1024), 1),
+        },
+    }
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(previous, current, tolerance):
+    """Print per-scenario deltas, returns the number of regressions beyond tolerance"""
+    baseline = {(s['mode'], s['size_mb'], s['jobs']): s for s in previous['scenarios']}
+    regressions = 0
+    print(f"\n📊 Compared with {previous.get('version') or 'previous run'} ({previous.get('timestamp')})")
+    for scenario in current['scenarios']:
+        old = baseline.get((scenario['mode'], scenario['size_mb'], scenario['jobs']))
+        if not old:
+            continue
+        # (metric, value getter, True when higher is better)
+        checks = (
+            ('throughput', lambda s: s['throughput_mbps'], True),
+            ('cpu/GB', lambda s: s['cpu_s_per_gb'], False),
+            ('p95', lambda s: s['latency_s'].get('p95'), False),
+            ('rss', lambda s: s['peak_rss_mb'], False),
+        )
+        notes = []
+        for name, value, higher_is_better in checks:
+            before, after = value(old), value(scenario)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            regressions += worse
+            notes.append(f"{name} {change:+.0%}{' ⚠️' if worse else ''}")
+        print(f"  {scenario['mode']:6} {scenario['size_mb']:5} MB x{scenario['jobs']}: {', '.join(notes)}")
+    return regressions
+
+async def main(args):
+    # Isolated journal, caches and traces; the bot reads these at import
+    workdir = tempfile.mkdtemp(prefix='stb-bench-')
+    os.environ['JOURNAL_DB'] = os.path.join(workdir, 'jobs.db')
+    os.environ['PERF_DB'] = ''
+    sys.path.insert(0, APP_DIR)
+    import bot
+
+    # Retries and failures are counted in the results, keep the table readable
+    logging.getLogger('bot').setLevel(logging.ERROR)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    # Fake Drive endpoints and credentials, nothing leaves the machine
+    drive = f"http://127.0.0.1:{DRIVE_PORT}"
+    bot.DRIVE_UPLOAD_URL = f"{drive}/upload"
+    bot.DRIVE_API_URL = f"{drive}/api"
+    bot.DRIVE_BATCH_URL = f"{drive}/batch"
+    bot.drive_manager.credentials = SimpleNamespace(token='bench', expiry=None, refresh_token=None, valid=True)
+    bot.drive_manager.connected = True
+
+    servers = [
+        multiprocessing.Process(target=run_origin, daemon=True, args=(
+            ORIGIN_PORT, args.origin_latency, args.origin_error_rate, args.stall_rate, args.stall_seconds,
+            args.drop_rate)),
+        multiprocessing.Process(target=run_drive, daemon=True, args=(
+            DRIVE_PORT, args.drive_latency, args.drive_error_rate, args.drive_mbps)),
+    ]
+    for server in servers:
+        server.start()
+    await wait_for(f"http://127.0.0.1:{ORIGIN_PORT}/files/ping?size=1")
+    await wait_for(f"{drive}/api/files")
+
+    bot.download_manager.start()
+    bot.upload_stage.start()
+
+    results = {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {
+            'CHUNK_SIZE': bot.CHUNK_SIZE,
+            'CHUNK_SIZE_MAX': bot.CHUNK_SIZE_MAX,
+            'WRITE_BUFFER_SIZE': bot.WRITE_BUFFER_SIZE,
+            'MAX_SPEED_MBPS': bot.bandwidth_governor.rate_mbps,
+            'MAX_CONCURRENT_DOWNLOADS': bot.MAX_CONCURRENT,
+            'MAX_CONCURRENT_UPLOADS': bot.MAX_CONCURRENT_UPLOADS,
+            'DOWNLOAD_SEGMENTS': bot.DOWNLOAD_SEGMENTS,
+            'UPLOAD_CHUNK_SIZE': bot.UPLOAD_CHUNK_SIZE,
+            'STREAM_BUFFER_SIZE': bot.STREAM_BUFFER_SIZE,
+        },
+        'faults': {key: getattr(args, key) for key in (
+            'origin_latency', 'origin_error_rate', 'stall_rate', 'stall_seconds', 'drop_rate',
+            'drive_latency', 'drive_error_rate', 'drive_mbps')},
+        'scenarios': [],
+    }
+
+    print(f"📊 STB benchmark {results['version'] or ''} - speed limit {bot.bandwidth_governor.rate_mbps or 'off'} MB/s, "
+          f"{bot.MAX_CONCURRENT} download / {bot.MAX_CONCURRENT_UPLOADS} upload workers")
+    for mode in args.modes:
+        for size_mb in args.sizes:
+            scenario = await run_scenario(bot, mode, size_mb, args.jobs, workdir)
+            results['scenarios'].append(scenario)
+            print(f"  {mode:6} {size_mb:5} MB x{args.jobs}: {scenario['throughput_mbps']:8.1f} MB/s  "
+                  f"{scenario['cpu_s_per_gb'] or 0:7.2f} CPU s/GB  {scenario['peak_rss_mb']:6.1f} MB RSS  "
+                  f"p95 {scenario['latency_s'].get('p95', 0):.2f}s  failed {scenario['failed']}")
+
+    await bot.close_http_session()
+    for server in servers:
+        server.terminate()
+
+    output = args.output or f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            print(f"⚠️ {regressions} regressions beyond {args.tolerance:.0%}")
+            return 1
+    return 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline STB download/upload pipeline benchmark")
+    parser.add_argument('--modes', default='disk,stream,upload',
+                        type=lambda value: value.split(','), help="disk, stream and/or upload")
+    parser.add_argument('--sizes', default='8,64', type=lambda value: [int(size) for size in value.split(',')],
+                        help="file sizes in MB")
+    parser.add_argument('--jobs', default=4, type=int, help="jobs per scenario")
+    parser.add_argument('--origin-latency', default=0.0, type=float, help="seconds before each origin response")
+    parser.add_argument('--origin-error-rate', default=0.0, type=float, help="share of origin requests answered 503")
+    parser.add_argument('--stall-rate', default=0.0, type=float, help="share of origin bodies that pause midway")
+    parser.add_argument('--stall-seconds', default=5.0, type=float)
+    parser.add_argument('--drop-rate', default=0.0, type=float, help="share of origin bodies cut off midway")
+    parser.add_argument('--drive-latency', default=0.0, type=float, help="seconds added to each Drive call")
+    parser.add_argument('--drive-error-rate', default=0.0, type=float, help="share of upload chunks answered 503")
+    parser.add_argument('--drive-mbps', default=0.0, type=float, help="simulated Drive ingest speed, 0 = unlimited")
+    parser.add_argument('--output', help="result file, defaults to bench-<timestamp>.json")
+    parser.add_argument('--compare', help="earlier result file to check for regressions")
+    parser.add_argument('--tolerance', default=0.1, type=float, help="relative change counted as a regression")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+STB handler load test
+
+Feeds synthetic updates into the Application built by the bot (same
+handlers, same settings) at increasing rates. Bot API calls go to a local
+stand-in server running in a child process, so nothing reaches Telegram.
+
+Per rate step it reports throughput, per-handler latency percentiles
+(queueing included), event-loop lag, and every stretch where one callback
+held the loop longer than --block-threshold, with the code it was running.
+Results are saved as JSON.
+
+Usage (inside the container):
+    python /app/scripts/loadtest.py --rates 10,50,100,200 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# /app/scripts in the container, scripts/ next to app/ in the repo
+for candidate in (os.path.join(SCRIPT_DIR, '..', 'app'), os.path.join(SCRIPT_DIR, '..')):
+    if os.path.exists(os.path.join(candidate, 'bot.py')):
+        APP_DIR = os.path.abspath(candidate)
+        break
+
+API_PORT = 18993
+BOT_ID = 4242
+# Weighted update mix, kinds are command names plus 'inline'
+DEFAULT_MIX = {'start': 3, 'help': 2, 'stats': 3, 'system': 2, 'inline': 4, 'd': 1}
+
+def run_fake_api(port, latency):
+    """Bot API stand-in: answers every method with a plausible result"""
+    from aiohttp import web
+
+    def user(user_id, username=None):
+        return {'id': user_id, 'is_bot': user_id == BOT_ID, 'first_name': f"user{user_id}",
+                'username': username or f"user{user_id}"}
+
+    def message(params, message_id=None):
+        chat_id = int(params.get('chat_id', 1))
+        return {'message_id': message_id or random.randint(1, 2 ** 31), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'from': user(BOT_ID, 'loadtest_bot'),
+                'text': params.get('text', '')}
+
+    async def handler(request):
+        if latency:
+            await asyncio.sleep(latency)
+        method = request.match_info['method']
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+
+        if method == 'getMe':
+            result = {**user(BOT_ID, 'loadtest_bot'), 'can_join_groups': True,
+                      'can_read_all_group_messages': False, 'supports_inline_queries': True}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': user(int(params.get('user_id', 1)))}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = message(params, params.get('message_id') and int(params['message_id']))
+        elif method == 'getUpdates':
+            await asyncio.sleep(1)
+            result = []
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handler)
+    app.router.add_get('/bot{token}/{method}', handler)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+class LoopWatchdog:
+    """Flags callbacks that hold the event loop longer than a threshold
+
+    A heartbeat task ticks on the loop; a thread notices when the ticks
+    stop and records the loop thread's stack at that moment, so a blocked
+    loop is attributed to the code that blocked it.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.last_tick = time.monotonic()
+        self.loop_thread = threading.get_ident()
+        self.events = []
+        self.lags = []
+        self.running = False
+
+    async def heartbeat(self, interval=0.01):
+        """Ticks the watchdog and measures how late each wake-up is (loop lag)"""
+        while self.running:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self.lags.append(max(0.0, now - expected))
+            self.last_tick = now
+
+    def watch(self):
+        stalled_since = None
+        stack = None
+        while self.running:
+            time.sleep(self.threshold / 4)
+            now = time.monotonic()
+            if now - self.last_tick > self.threshold:
+                if stalled_since is None:
+                    stalled_since = self.last_tick
+                    frame = sys._current_frames().get(self.loop_thread)
+                    stack = traceback.format_stack(frame)[-6:] if frame else []
+            elif stalled_since is not None:
+                self.events.append({'held_s': round(self.last_tick - stalled_since, 3), 'stack': self.where(stack),
+                                    'trace': [line.strip() for line in stack]})
+                stalled_since = None
+
+    @staticmethod
+    def where(stack):
+        """Innermost frame inside the bot, else the innermost frame"""
+        for line in reversed(stack):
+            if 'bot.py' in line:
+                return line.strip().splitlines()[0]
+        return stack[-1].strip().splitlines()[0] if stack else 'unknown'
+
+    def start(self):
+        self.running = True
+        self.lag_task = asyncio.create_task(self.heartbeat())
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        self.running = False
+        await self.lag_task
+        self.thread.join()
+
+    def take(self):
+        """Lag samples and blocking events since the last call"""
+        lags, events = self.lags, self.events
+        self.lags, self.events = [], []
+        return lags, events
+
+class HandlerTimer:
+    """Wraps handler callbacks to record when each update finished"""
+
+    def __init__(self, app):
+        self.enqueued = {}
+        self.latencies = {}
+        self.errors = {}
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = self.wrap(handler.callback)
+
+    def wrap(self, callback):
+        name = callback.__name__
+
+        async def timed(update, context):
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.errors[name] = self.errors.get(name, 0) + 1
+                raise
+            finally:
+                started = self.enqueued.pop(update.update_id, None)
+                if started is not None:
+                    self.latencies.setdefault(name, []).append(time.monotonic() - started)
+
+        timed.__name__ = name
+        return timed
+
+    def take(self):
+        latencies, errors = self.latencies, self.errors
+        self.latencies, self.errors = {}, {}
+        return latencies, errors
+
+class UpdateFactory:
+    """Synthetic Telegram updates for the configured mix"""
+
+    def __init__(self, users, mix):
+        self.users = users
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.update_id = 0
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'username': f"user{user_id}"}
+
+    def next(self):
+        self.update_id += 1
+        user_id = 1000 + random.randrange(self.users)
+        kind = random.choices(self.kinds, self.weights)[0]
+
+        if kind == 'inline':
+            return {'update_id': self.update_id, 'inline_query': {
+                'id': str(self.update_id), 'from': self.user(user_id),
+                'query': random.choice(['', 'system', 'status', 'help']), 'offset': ''}}
+
+        text = f"/{kind}"
+        if kind == 'd':
+            text += f" http://127.0.0.1:9/file{self.update_id}.bin"
+        return {'update_id': self.update_id, 'message': {
+            'message_id': self.update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self.user(user_id),
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}}
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda fraction: values[max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))]
+    return {'count': len(values), 'p50': round(pick(0.5) * 1000, 2), 'p95': round(pick(0.95) * 1000, 2),
+            'p99': round(pick(0.99) * 1000, 2), 'max': round(values[-1] * 1000, 2)}
+
+async def run_step(app, timer, watchdog, factory, rate, duration):
+    """Offer updates at a fixed rate (open loop), then wait for the backlog to drain"""
+    from telegram import Update
+
+    watchdog.take()
+    timer.take()
+    started = time.monotonic()
+    sent = 0
+    while time.monotonic() - started < duration:
+        due = started + sent / rate
+        await asyncio.sleep(max(0.0, due - time.monotonic()))
+        update = Update.de_json(factory.next(), app.bot)
+        timer.enqueued[update.update_id] = time.monotonic()
+        await app.update_queue.put(update)
+        sent += 1
+
+    # Let the backlog drain, but do not wait forever on an overloaded step
+    deadline = time.monotonic() + max(10.0, duration)
+    while timer.enqueued and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+
+    # Whatever is still queued would skew the next step
+    dropped = 0
+    while not app.update_queue.empty():
+        app.update_queue.get_nowait()
+        app.update_queue.task_done()
+        dropped += 1
+
+    latencies, errors = timer.take()
+    lags, events = watchdog.take()
+    completed = sum(len(values) for values in latencies.values())
+    timer.enqueued.clear()
+
+    blocking = {}
+    for event in events:
+        entry = blocking.setdefault(event['stack'], {'count': 0, 'max_held_ms': 0, 'trace': event['trace']})
+        entry['count'] += 1
+        entry['max_held_ms'] = max(entry['max_held_ms'], round(event['held_s'] * 1000, 1))
+
+    return {
+        'rate': rate,
+        'offered': sent,
+        'completed': completed,
+        'dropped': dropped,
+        'throughput_per_s': round(completed / elapsed, 1) if elapsed else 0,
+        'handlers_ms': {name: percentiles(values) for name, values in sorted(latencies.items())},
+        'errors': errors,
+        'loop_lag_ms': percentiles(lags),
+        'blocking': [{'where': where, **entry} for where, entry in
+                     sorted(blocking.items(), key=lambda item: -item[1]['max_held_ms'])],
+    }
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+async def main(args):
+    # Isolated journal and caches, no metrics port; the bot reads these at import
+    workdir = tempfile.mkdtemp(prefix='stb-loadtest-')
+    os.environ['JOURNAL_DB'] = os.path.join(workdir, 'jobs.db')
+    os.environ['PERF_DB'] = ''
+    os.environ['METRICS_PORT'] = '0'
+    sys.path.insert(0, APP_DIR)
+    import bot
+
+    logging.getLogger('bot').setLevel(logging.ERROR)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    api = multiprocessing.Process(target=run_fake_api, args=(API_PORT, args.api_latency), daemon=True)
+    api.start()
+
+    app = bot.build_application(base_url=f"http://127.0.0.1:{API_PORT}/bot")
+    for _ in range(100):
+        try:
+            await app.initialize()
+            break
+        except Exception:
+            await asyncio.sleep(0.1)
+    else:
+        raise SystemExit("Fake Bot API did not start")
+
+    # Same background work as a real start: scheduler, system sampler, Drive loader
+    await bot.post_init(app)
+    await app.start()
+
+    timer = HandlerTimer(app)
+    watchdog = LoopWatchdog(args.block_threshold)
+    watchdog.start()
+    factory = UpdateFactory(args.users, args.mix)
+
+    results = {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {'users': args.users, 'duration_s': args.duration, 'mix': args.mix,
+                     'api_latency_s': args.api_latency, 'block_threshold_s': args.block_threshold},
+        'steps': [],
+    }
+
+    print(f"🧪 STB handler load test {results['version'] or ''} - {args.users} users, "
+          f"{args.duration:.0f}s per step, blocking threshold {args.block_threshold * 1000:.0f} ms")
+    for rate in args.rates:
+        step = await run_step(app, timer, watchdog, factory, rate, args.duration)
+        results['steps'].append(step)
+        lag = step['loop_lag_ms']
+        print(f"  {rate:5} upd/s offered: {step['throughput_per_s']:7.1f} handled/s, "
+              f"loop lag p99 {lag.get('p99', 0):.1f} ms / max {lag.get('max', 0):.1f} ms, "
+              f"{sum(entry['count'] for entry in step['blocking'])} blocking callbacks"
+              f"{', %d dropped' % step['dropped'] if step['dropped'] else ''}")
+        for name, stats in step['handlers_ms'].items():
+            print(f"        {name:18} p50 {stats['p50']:8.1f} ms  p95 {stats['p95']:8.1f} ms  "
+                  f"p99 {stats['p99']:8.1f} ms  ({stats['count']})")
+        for entry in step['blocking'][:3]:
+            print(f"        ⚠️ held loop {entry['max_held_ms']:.0f} ms x{entry['count']}: {entry['where']}")
+
+    # Non-blocking inline handlers may still be debouncing
+    await asyncio.sleep(bot.INLINE_DEBOUNCE + 1)
+    await watchdog.stop()
+    await app.stop()
+    await app.shutdown()
+    await bot.post_shutdown(app)
+    api.terminate()
+
+    output = args.output or f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results saved to {output}")
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        mix[kind] = int(weight or 1)
+    return mix
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the bot's update handlers against a fake Bot API")
+    parser.add_argument('--rates', default='10,50,100,200', type=lambda value: [int(rate) for rate in value.split(',')],
+                        help="offered updates per second, one step each")
+    parser.add_argument('--duration', default=10.0, type=float, help="seconds per rate step")
+    parser.add_argument('--users', default=200, type=int, help="distinct synthetic users")
+    parser.add_argument('--mix', default=','.join(f"{kind}={weight}" for kind, weight in DEFAULT_MIX.items()),
+                        type=parse_mix, help="update kinds and weights, e.g. start=3,stats=1,inline=2")
+    parser.add_argument('--api-latency', default=0.02, type=float, help="seconds per fake Bot API call")
+    parser.add_argument('--block-threshold', default=0.05, type=float,
+                        help="flag callbacks holding the event loop longer than this many seconds")
+    parser.add_argument('--output', help="result file, defaults to loadtest-<timestamp>.json")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))